@@ -1,40 +1,151 @@
 import secrets
 import string
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, session, make_response, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, session, make_response, send_file, g, jsonify, abort
+from flask import has_app_context, has_request_context, before_render_template, template_rendered
+from werkzeug.security import generate_password_hash, check_password_hash
+import click
+from werkzeug.serving import make_server
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 import sys
 import io
-import pandas as pd
+import queue
+import threading
+import csv
+import zipfile
+import tempfile
+import gzip
+import shutil
+import hashlib
+import time
+import signal
+import socket
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from openpyxl import Workbook, load_workbook
+import json
+import base64
+import re
+from email.message import EmailMessage
+from email.utils import format_datetime, make_msgid
 
 app = Flask(__name__)
 app.secret_key = secrets.token_hex(24)
 DB_FILE = "device_loans.db"
 
+# --- Database Connection Settings ---
+DB_POOL_SIZE = 8             # idle connections kept per database file
+DB_BUSY_TIMEOUT_MS = 5000    # how long a writer waits for the lock before "database is locked"
+DB_CACHE_SIZE_KB = 16384     # page cache per connection (negative cache_size = KiB)
+DB_MMAP_SIZE = 64 * 1024 * 1024
+DB_CACHED_STATEMENTS = 256   # prepared statements cached per connection
+
+# --- Sites ---
+# One server can host several sites (schools), each with its own database file (shard), so
+# a busy site's writers never hold up another site's lock. SITES="north=north.db,south=south.db"
+# turns this on. A request picks its site from a /site/<name>/ URL prefix (moved into
+# SCRIPT_NAME, so every url_for() keeps it) or else the last site this browser used.
+# The admin login and session secret stay in DB_FILE. With no SITES everything uses
+# DB_FILE as before.
+
+SITES = {name.strip(): path.strip() for name, _, path in
+         (entry.partition("=") for entry in os.environ.get("SITES", "").split(",")) if name.strip() and path.strip()}
+SITE_URL_PREFIX = "/site/"
+
+class SiteDispatcher:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if SITES and path.startswith(SITE_URL_PREFIX):
+            name, _, rest = path[len(SITE_URL_PREFIX):].partition('/')
+            if name in SITES:
+                environ['devicelogger.root'] = environ.get('SCRIPT_NAME', '')
+                environ['devicelogger.site'] = name
+                environ['SCRIPT_NAME'] = environ['devicelogger.root'] + SITE_URL_PREFIX + name
+                environ['PATH_INFO'] = '/' + rest
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = SiteDispatcher(app.wsgi_app)
+
+@app.before_request
+def select_site():
+    site = request.environ.get('devicelogger.site')
+    if site:
+        if session.get('site') != site:
+            session['site'] = site
+    elif session.get('site') in SITES:
+        site = session['site']
+    else:
+        site = next(iter(SITES), None)
+    g.site = site
+
+@app.context_processor
+def inject_site():
+    return {'site': current_site(), 'sites': list(SITES), 'site_url': site_url}
+
+def current_site():
+    return g.get('site') if has_app_context() else None
+
+def current_db_file():
+    # Outside a request (CLI commands, background jobs) callers pass their db_file explicitly
+    return SITES.get(current_site(), DB_FILE)
+
+def iter_sites():
+    """(site, db_file) for every shard; a single (None, DB_FILE) when SITES isn't set."""
+    return list(SITES.items()) or [(None, DB_FILE)]
+
+def all_db_files():
+    # DB_FILE always holds the admin settings, even when it isn't one of the sites
+    return list(dict.fromkeys([DB_FILE, *SITES.values()]))
+
+def site_url(site, endpoint, **values):
+    """url_for() on another site's shard, from within a request."""
+    path = url_for(endpoint, **values)[len(request.script_root):]
+    root = request.environ.get('devicelogger.root', request.script_root)
+    return f"{root}{SITE_URL_PREFIX}{site}{path}" if site else root + path
+
 # --- Admin Authentication Setup ---
-ADMIN_USERNAME = ""
-ADMIN_PASSWORD = ""
+# The session secret and admin login are kept in the settings table (only a hash of the
+# password), so every worker process signs and checks sessions the same way.
+
+def get_setting(c, key, default=None):
+    row = c.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
 
-def generate_credentials():
-    global ADMIN_USERNAME, ADMIN_PASSWORD
+def set_setting(c, key, value):
+    c.execute("INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, value))
+
+def generate_credentials(c):
     random_suffix = ''.join(secrets.choice(string.digits) for _ in range(4))
-    ADMIN_USERNAME = f"admin_{random_suffix}"
+    username = f"admin_{random_suffix}"
     chars = string.ascii_letters + string.digits + "!@#$%^&*"
-    ADMIN_PASSWORD = ''.join(secrets.choice(chars) for _ in range(16))
+    password = ''.join(secrets.choice(chars) for _ in range(16))
+    set_setting(c, 'admin_username', username)
+    set_setting(c, 'admin_password_hash', generate_password_hash(password))
+    set_setting(c, 'secret_key', secrets.token_hex(32))  # new credentials also sign everyone out
 
     print("\n" + "="*50)
     print("!!! ADMIN ACCESS CREDENTIALS !!!")
-    print(f"USERNAME: {ADMIN_USERNAME}")
-    print(f"PASSWORD: {ADMIN_PASSWORD}")
+    print(f"USERNAME: {username}")
+    print(f"PASSWORD: {password}")
     print("Please use these to log into the /admin panel.")
-    print("Credentials are valid ONLY for this session.")
+    print("Credentials are valid until new ones are generated.")
     print("="*50 + "\n")
 
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    # Added 'notes' column to devices table
+def check_admin_login(c, username, password):
+    stored_username = get_setting(c, 'admin_username')
+    stored_hash = get_setting(c, 'admin_password_hash')
+    return bool(stored_username and stored_hash and username == stored_username
+                and check_password_hash(stored_hash, password or ""))
+
+# --- Schema Migrations ---
+# Each entry upgrades the database by exactly one version; PRAGMA user_version records
+# the last one applied, so startup only runs the steps an existing file is missing.
+
+def _migration_base_schema(c):
     c.execute('''CREATE TABLE IF NOT EXISTS devices (
                     id INTEGER PRIMARY KEY AUTOINCREMENT, rubric_id TEXT, suffix_id TEXT,
                     category TEXT, available INTEGER, notes TEXT,
@@ -46,15 +157,147 @@ def init_db():
                     loan_time TEXT, return_time TEXT,
                     FOREIGN KEY(student_id) REFERENCES students(id),
                     FOREIGN KEY(device_id) REFERENCES devices(id))''')
-    
-    # Migration check: Add notes column if it doesn't exist in an old DB file
-    try:
+    # Database files from before the notes feature have a devices table without it
+    columns = [row[1] for row in c.execute("PRAGMA table_info(devices)")]
+    if 'notes' not in columns:
         c.execute("ALTER TABLE devices ADD COLUMN notes TEXT")
-    except sqlite3.OperationalError:
-        pass # Column already exists
-        
-    conn.commit()
-    conn.close()
+
+def _migration_query_indexes(c):
+    # Active loans are a tiny slice of history: /return, /admin and "mark as handed in" all
+    # filter on return_time IS NULL, so a partial index keeps those lookups off the full table.
+    c.execute("CREATE INDEX IF NOT EXISTS idx_loans_active ON loans(device_id, student_id) WHERE return_time IS NULL")
+    # device_detail: WHERE device_id = ? ORDER BY loan_time DESC
+    c.execute("CREATE INDEX IF NOT EXISTS idx_loans_device_time ON loans(device_id, loan_time)")
+    # Loan history ordering on the admin page
+    c.execute("CREATE INDEX IF NOT EXISTS idx_loans_loan_time ON loans(loan_time)")
+    # /loan: WHERE available = 1 (covering, so the device list never touches the table)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_devices_available_category ON devices(available, category, rubric_id, suffix_id)")
+    # SELECT DISTINCT category
+    c.execute("CREATE INDEX IF NOT EXISTS idx_devices_category ON devices(category)")
+
+def _migration_stats_rollups(c):
+    # Utilisation rollups, kept current by record_loan_stats/record_return_stats.
+    # Loans count on the day they start; returns and loan time count on the day they end.
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_daily (
+                    day TEXT NOT NULL, category TEXT NOT NULL, loans INTEGER NOT NULL DEFAULT 0,
+                    returns INTEGER NOT NULL DEFAULT 0, loan_seconds REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY(day, category)) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_device (
+                    device_id INTEGER PRIMARY KEY, loans INTEGER NOT NULL DEFAULT 0, returns INTEGER NOT NULL DEFAULT 0,
+                    loan_seconds REAL NOT NULL DEFAULT 0, last_loan_time TEXT)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_stats_device_loans ON stats_device(loans)")
+    rebuild_stats(c)
+
+def _migration_shared_state(c):
+    # Process-wide state that worker processes have to agree on: the session secret and
+    # admin login (settings), and the change log that keeps their caches and live feeds in step.
+    c.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value) WITHOUT ROWID")
+    c.execute('''CREATE TABLE IF NOT EXISTS change_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, type TEXT NOT NULL, data TEXT NOT NULL)''')
+
+def _migration_search_index(c):
+    # FTS5 copies of the searchable device and student text (rowid = the source row's id),
+    # kept current by triggers. device_key is the ID without dashes, for scanned/typed labels.
+    # Loan history is searched through these: a loan matches when its device or student does.
+    device_key = "upper(replace(replace({0}.rubric_id || {0}.suffix_id, '-', ''), ' ', ''))"
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS search_devices USING fts5(
+                    full_id, device_key, category, notes, tokenize = "unicode61 remove_diacritics 2", prefix = "2 3")''')
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS search_students USING fts5(
+                    name, surname, email, tokenize = "unicode61 remove_diacritics 2", prefix = "2 3")''')
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS search_devices_insert AFTER INSERT ON devices BEGIN
+                    INSERT INTO search_devices (rowid, full_id, device_key, category, notes)
+                    VALUES (new.id, new.rubric_id || '-' || new.suffix_id, {device_key.format('new')}, new.category, new.notes);
+                  END""")
+    # UPDATE OF keeps the constant available-flag updates from checkouts away from the index
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS search_devices_update AFTER UPDATE OF rubric_id, suffix_id, category, notes ON devices BEGIN
+                    UPDATE search_devices SET full_id = new.rubric_id || '-' || new.suffix_id, device_key = {device_key.format('new')},
+                        category = new.category, notes = new.notes WHERE rowid = old.id;
+                  END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS search_devices_delete AFTER DELETE ON devices BEGIN
+                    DELETE FROM search_devices WHERE rowid = old.id;
+                  END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS search_students_insert AFTER INSERT ON students BEGIN
+                    INSERT INTO search_students (rowid, name, surname, email) VALUES (new.id, new.name, new.surname, new.email);
+                  END""")
+    # Checkouts upsert the student every time, usually with the same values
+    c.execute("""CREATE TRIGGER IF NOT EXISTS search_students_update AFTER UPDATE OF name, surname, email ON students
+                  WHEN old.name IS NOT new.name OR old.surname IS NOT new.surname OR old.email IS NOT new.email BEGIN
+                    UPDATE search_students SET name = new.name, surname = new.surname, email = new.email WHERE rowid = old.id;
+                  END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS search_students_delete AFTER DELETE ON students BEGIN
+                    DELETE FROM search_students WHERE rowid = old.id;
+                  END""")
+    c.execute("DELETE FROM search_devices")
+    c.execute("DELETE FROM search_students")
+    c.execute(f"""INSERT INTO search_devices (rowid, full_id, device_key, category, notes)
+                  SELECT id, rubric_id || '-' || suffix_id, {device_key.format('devices')}, category, notes FROM devices""")
+    c.execute("INSERT INTO search_students (rowid, name, surname, email) SELECT id, name, surname, email FROM students")
+    # A student's loan history, newest first
+    c.execute("CREATE INDEX IF NOT EXISTS idx_loans_student_time ON loans(student_id, loan_time)")
+
+def _migration_overdue_tracking(c):
+    columns = [row[1] for row in c.execute("PRAGMA table_info(loans)")]
+    if 'due_time' not in columns:
+        c.execute("ALTER TABLE loans ADD COLUMN due_time TEXT")
+    backfill_due_times(c)
+    # Overdue check: open loans only, range-scanned by due time
+    c.execute("CREATE INDEX IF NOT EXISTS idx_loans_due ON loans(due_time) WHERE return_time IS NULL")
+    # One outbox row per reminder message (a message can cover several of a student's loans);
+    # reminder_log's primary key is what stops a loan from ever being reminded about twice.
+    c.execute('''CREATE TABLE IF NOT EXISTS reminder_outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, recipient TEXT NOT NULL, subject TEXT NOT NULL,
+                    body TEXT NOT NULL, created_time TEXT NOT NULL, written_time TEXT)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_reminder_outbox_unwritten ON reminder_outbox(id) WHERE written_time IS NULL")
+    c.execute('''CREATE TABLE IF NOT EXISTS reminder_log (
+                    loan_id INTEGER PRIMARY KEY, reminder_id INTEGER NOT NULL, sent_time TEXT NOT NULL,
+                    FOREIGN KEY(loan_id) REFERENCES loans(id), FOREIGN KEY(reminder_id) REFERENCES reminder_outbox(id))''')
+
+def _migration_sort_indexes(c):
+    # Admin table sorts (see ADMIN_TABLES). Sort keys on nullable columns are IFNULL()ed so
+    # the keyset seek never compares against NULL, and these expression indexes let each of
+    # those sorts walk an index instead of sorting the whole table on every page.
+    c.execute("CREATE INDEX IF NOT EXISTS idx_students_sort_name ON students(IFNULL(surname, ''), IFNULL(name, ''))")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_devices_sort_id ON devices(IFNULL(rubric_id, ''), IFNULL(suffix_id, ''))")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_loans_sort_return ON loans(IFNULL(return_time, ''))")
+
+MIGRATIONS = [
+    _migration_base_schema,     # version 1
+    _migration_query_indexes,   # version 2
+    _migration_stats_rollups,   # version 3
+    _migration_shared_state,    # version 4
+    _migration_search_index,    # version 5
+    _migration_overdue_tracking,  # version 6
+    _migration_sort_indexes,    # version 7
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def run_migrations(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Database schema version {version} is newer than this app supports ({SCHEMA_VERSION}).")
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            c = conn.cursor()
+            c.execute("BEGIN")  # DDL doesn't open an implicit transaction, so make each step atomic
+            migration(c)
+            c.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    return version
+
+def init_db(db_file=None):
+    conn = sqlite3.connect(db_file or DB_FILE)
+    # WAL is persistent in the file, so switching once here covers every later connection.
+    # Readers then never block behind a writer (and vice versa).
+    conn.execute("PRAGMA journal_mode = WAL")
+    try:
+        if run_migrations(conn) < SCHEMA_VERSION:
+            conn.execute("ANALYZE")  # give the planner stats for the new indexes
+        conn.execute("PRAGMA optimize")
+    finally:
+        conn.close()
 
 # --- Utility Functions ---
 
@@ -67,8 +310,282 @@ def login_required(f):
     decorated_function.__name__ = f.__name__
     return decorated_function
 
+# --- Instrumentation ---
+# Every pooled connection is a TracedConnection, so each statement's execute time is
+# counted against the current request and route. Route latency and template render time
+# come from request hooks and Flask's template signals; all of it is served in Prometheus
+# text format from /metrics. Statements slower than SLOW_QUERY_MS are logged once each,
+# with their query plan.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")           # if set, /metrics needs "Authorization: Bearer <token>"
+SERVER_TIMING_HEADER = os.environ.get("SERVER_TIMING") == "1"  # per-request Server-Timing debug header
+SLOW_QUERY_MS = 100
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self, name, help_text, labels):
+        self.name, self.help_text, self.labels = name, help_text, labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(METRIC_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(METRIC_BUCKETS):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(key, list(buckets), total, count) for key, (buckets, total, count) in self._series.items()]
+        for label_values, buckets, total, count in sorted(snapshot):
+            labels = ",".join(f'{k}="{_metric_label(v)}"' for k, v in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, n in zip(METRIC_BUCKETS, buckets):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+def _metric_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+REQUEST_SECONDS = Histogram("devicelogger_request_duration_seconds", "Time to build and send each response, by route.", ("endpoint", "method", "status"))
+QUERY_SECONDS = Histogram("devicelogger_sql_query_duration_seconds", "SQLite statement execute time, by route and statement type.", ("endpoint", "statement"))
+TEMPLATE_SECONDS = Histogram("devicelogger_template_render_seconds", "Jinja render time, by template.", ("template",))
+_slow_query_count = 0
+_explained_queries = set()
+_explain_lock = threading.Lock()
+
+def _current_endpoint():
+    if has_request_context():
+        return request.endpoint or "unknown"
+    return "background"
+
+def _statement_kind(sql):
+    words = sql.split(None, 1)
+    return words[0].upper() if words else "OTHER"
+
+def _record_query(conn, sql, params, elapsed):
+    global _slow_query_count
+    endpoint = _current_endpoint()
+    kind = _statement_kind(sql)
+    QUERY_SECONDS.observe(elapsed, endpoint, kind)
+    if has_app_context():
+        g.sql_count = g.get('sql_count', 0) + 1
+        g.sql_seconds = g.get('sql_seconds', 0.0) + elapsed
+    if elapsed * 1000 < SLOW_QUERY_MS:
+        return
+    with _explain_lock:
+        _slow_query_count += 1
+        first_time = sql not in _explained_queries and len(_explained_queries) < 1000
+        _explained_queries.add(sql)
+    if not first_time:
+        return
+    plan = ""
+    if params is not None and kind in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH"):
+        try:
+            rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+            plan = "".join(f"\n    {row[-1]}" for row in rows)
+        except sqlite3.Error:
+            pass
+    print(f"Slow query ({elapsed * 1000:.1f} ms, {endpoint}): {' '.join(sql.split())}{plan}", file=sys.stderr)
+
+class TracedCursor(sqlite3.Cursor):
+    # SQLite does most of a SELECT's work while its rows are stepped through, not in
+    # execute(), so time spent fetching is added to the statement, which is only recorded
+    # once its rows run out (or the cursor runs something else, is closed or goes away).
+    _pending = None
+
+    def _finish(self):
+        pending, self._pending = self._pending, None
+        if pending:
+            _record_query(self.connection, *pending)
+
+    def _timed_fetch(self, fetch, *args):
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            if self._pending:
+                sql, params, elapsed = self._pending
+                self._pending = (sql, params, elapsed + time.perf_counter() - start)
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._pending = (sql, parameters, time.perf_counter() - start)
+            if self.description is None:  # no rows to fetch
+                self._finish()
+
+    def fetchone(self):
+        row = self._timed_fetch(super().fetchone)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._timed_fetch(super().fetchmany, size)
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed_fetch(super().fetchall)
+        self._finish()
+        return rows
+
+    def __next__(self):
+        try:
+            return self._timed_fetch(super().__next__)
+        except StopIteration:
+            self._finish()
+            raise
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        self._finish()
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_query(self.connection, sql, None, time.perf_counter() - start)
+
+    def executescript(self, sql_script):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            _record_query(self.connection, sql_script, None, time.perf_counter() - start)
+
+class TracedConnection(sqlite3.Connection):
+    # Connection.execute() and friends don't go through cursor(), so route them explicitly
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_timing(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    labels = (request.endpoint or "unknown", request.method, response.status_code)
+    # Observed when the body has been sent, so streamed exports are timed end to end
+    response.call_on_close(lambda: REQUEST_SECONDS.observe(time.perf_counter() - started, *labels))
+    if SERVER_TIMING_HEADER:
+        response.headers["Server-Timing"] = (
+            f'db;dur={g.get("sql_seconds", 0.0) * 1000:.2f};desc="{g.get("sql_count", 0)} queries", '
+            f'tpl;dur={g.get("template_seconds", 0.0) * 1000:.2f}, total;dur={elapsed * 1000:.2f}')
+    return response
+
+@before_render_template.connect_via(app)
+def _start_template_timer(sender, template, context, **extra):
+    g.setdefault('template_starts', []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def _record_template_timing(sender, template, context, **extra):
+    starts = g.get('template_starts')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    g.template_seconds = g.get('template_seconds', 0.0) + elapsed
+    TEMPLATE_SECONDS.observe(elapsed, template.name or "string")
+
+# --- Database Connection Layer ---
+# Connections are opened once, tuned with pragmas, and then recycled through a small
+# pool instead of being opened/closed by every route. Each app context borrows one
+# connection (stored on flask.g) and hands it back in teardown_db_connection, so routes
+# no longer need to close connections by hand (and error paths can't leak them).
+
+_db_pools = {}
+_db_pools_lock = threading.Lock()
+
+def _get_pool(db_file):
+    with _db_pools_lock:
+        pool = _db_pools.get(db_file)
+        if pool is None:
+            pool = _db_pools[db_file] = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+        return pool
+
+def open_db_connection(db_file=None):
+    conn = sqlite3.connect(db_file or current_db_file(), timeout=DB_BUSY_TIMEOUT_MS / 1000, factory=TracedConnection,
+                           check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous = NORMAL")  # durable enough under WAL, far fewer fsyncs
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
 def get_db_connection():
-    return sqlite3.connect(DB_FILE)
+    conn = g.get('db')
+    if conn is None:
+        g.db_file = current_db_file()  # the pool it goes back to, whatever happens to g.site
+        try:
+            conn = _get_pool(g.db_file).get_nowait()
+        except queue.Empty:
+            conn = open_db_connection(g.db_file)
+        g.db = conn
+    return conn
+
+def release_db_connection(conn, db_file=None):
+    # Never hand a connection with a half-finished transaction to the next request.
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        _get_pool(db_file or current_db_file()).put_nowait(conn)
+    except (sqlite3.Error, queue.Full):
+        conn.close()
+
+@contextmanager
+def pooled_connection(db_file=None):
+    # For work that outlives the request context (streamed responses, background jobs)
+    db_file = db_file or current_db_file()
+    try:
+        conn = _get_pool(db_file).get_nowait()
+    except queue.Empty:
+        conn = open_db_connection(db_file)
+    try:
+        yield conn
+    finally:
+        release_db_connection(conn, db_file)
+
+@app.teardown_appcontext
+def teardown_db_connection(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        release_db_connection(conn, g.pop('db_file', None))
 
 def format_dt(iso_time_str):
     if not iso_time_str: return "N/A", "N/A"
@@ -78,6 +595,829 @@ def format_dt(iso_time_str):
     except ValueError:
         return "Invalid Date", "Invalid Time"
 
+# --- Page Data Cache ---
+# Kiosks reload /loan and /return constantly, but the data behind them only changes on a
+# loan, return or admin edit. Every write path calls publish_change() after it commits,
+# which bumps the generation (and tells live pages, see the change feed below); cached page data and ETags are tagged with the generation they were built at,
+# so an idle kiosk's conditional GET is answered with a 304 without touching SQLite.
+
+# With several worker processes (see `flask serve`) a write in one worker has to invalidate
+# the others, so the generation is then the last id in the shared change_events table.
+
+WORKER_PROCESSES = 1
+_BOOT_ID = secrets.token_hex(4)  # keeps ETags from an earlier run from matching this one
+_cache_lock = threading.Lock()
+_data_generations = {}
+_page_cache = {}
+
+def data_generation(db_file=None):
+    db_file = db_file or current_db_file()
+    if WORKER_PROCESSES > 1:
+        with pooled_connection(db_file) as conn:
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_events'").fetchone()
+        return row[0] if row else 0
+    return _data_generations.get(db_file, 0)
+
+def bump_data_generation(db_file=None):
+    db_file = db_file or current_db_file()
+    with _cache_lock:
+        _data_generations[db_file] = _data_generations.get(db_file, 0) + 1
+        for key in [k for k in _page_cache if k[0] == db_file]:
+            del _page_cache[key]
+
+def cached_page_data(key, loader, db_file=None):
+    db_file = db_file or current_db_file()
+    generation = data_generation(db_file)  # read before loading, so a concurrent write can't be masked
+    entry = _page_cache.get((db_file, key))
+    if entry and entry[0] == generation:
+        return entry[1]
+    value = loader()
+    with _cache_lock:
+        if data_generation(db_file) == generation:
+            _page_cache[(db_file, key)] = (generation, value)
+    return value
+
+def conditional_page(render):
+    # Flashed messages make a render one-off, so those pages are never cached or validated
+    if session.get('_flashes'):
+        response = make_response(render())
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    etag = f"{_BOOT_ID}-{data_generation()}"
+    if current_site():  # without a URL prefix the same path serves whichever site the session picked
+        etag += f"-{current_site()}"
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'  # always revalidate, but a 304 costs nothing
+    return response
+
+# --- Live Change Feed ---
+# Kiosks and the admin dashboard subscribe to /events (Server-Sent Events) and patch their
+# tables from small deltas instead of reloading. Each subscriber gets a bounded queue; one
+# that falls behind is sent a single "resync" event (reload) rather than blocking writers,
+# and the number of open streams is capped so they can't exhaust the server's threads.
+
+FEED_MAX_SUBSCRIBERS = 50
+FEED_QUEUE_SIZE = 100
+FEED_HEARTBEAT_SECONDS = 15
+
+class ChangeFeed:
+    def __init__(self, max_subscribers=FEED_MAX_SUBSCRIBERS, queue_size=FEED_QUEUE_SIZE):
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.last_id = 0
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            q = queue.Queue(self.queue_size)
+            self._subscribers.add(q)
+            return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def publish(self, event_type, data):
+        with self._lock:
+            self.last_id += 1
+            event = {'id': self.last_id, 'type': event_type, 'data': data}
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                # Too far behind to patch incrementally: replace the backlog with a resync
+                with q.mutex:
+                    q.queue.clear()
+                q.put_nowait({'id': event['id'], 'type': 'resync', 'data': {}})
+
+FEED_RELAY_INTERVAL_SECONDS = 1  # how often a worker picks up other workers' changes
+FEED_RELAY_KEEP = 10000          # change_events rows kept for workers that are catching up
+
+_PROCESS_ID = f"{os.getpid()}-{secrets.token_hex(2)}"
+_change_feeds = {}
+
+def get_change_feed(db_file=None):
+    db_file = db_file or current_db_file()
+    with _cache_lock:
+        feed = _change_feeds.get(db_file)
+        if feed is None:
+            feed = _change_feeds[db_file] = ChangeFeed()
+            if WORKER_PROCESSES > 1:
+                threading.Thread(target=_relay_changes, args=(feed, db_file), name="change-relay", daemon=True).start()
+        return feed
+
+def publish_change(event_type, db_file=None, **data):
+    db_file = db_file or current_db_file()
+    feed = get_change_feed(db_file)
+    if WORKER_PROCESSES > 1:
+        with pooled_connection(db_file) as conn:
+            conn.execute("INSERT INTO change_events (origin, type, data) VALUES (?, ?, ?)",
+                         (_PROCESS_ID, event_type, json.dumps(data)))
+            conn.commit()
+    bump_data_generation(db_file)
+    if event_type in INVENTORY_EVENTS:
+        invalidate_device_index(db_file)
+    feed.publish(event_type, data)
+
+def _relay_changes(feed, db_file):
+    # Replays other workers' changes into this worker's feed and caches
+    with pooled_connection(db_file) as conn:
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM change_events").fetchone()[0]
+    while True:
+        time.sleep(FEED_RELAY_INTERVAL_SECONDS)
+        try:
+            with pooled_connection(db_file) as conn:
+                rows = conn.execute("SELECT id, origin, type, data FROM change_events WHERE id > ? ORDER BY id",
+                                    (last_id,)).fetchall()
+                if rows and rows[-1][0] // 1000 != last_id // 1000:  # prune every thousand changes or so
+                    conn.execute("DELETE FROM change_events WHERE id <= ?", (rows[-1][0] - FEED_RELAY_KEEP,))
+                    conn.commit()
+        except sqlite3.Error as e:
+            print(f"Change relay failed: {e}", file=sys.stderr)
+            continue
+        for event_id, origin, event_type, data in rows:
+            last_id = event_id
+            if origin == _PROCESS_ID:
+                continue
+            bump_data_generation(db_file)
+            if event_type in INVENTORY_EVENTS:
+                invalidate_device_index(db_file)
+            feed.publish(event_type, json.loads(data))
+
+def feed_device(row):
+    # (id, rubric_id, suffix_id, category) -> the compact shape every event uses
+    return {'id': row[0], 'full_id': f"{row[1]}-{row[2]}", 'rubric_id': row[1], 'suffix_id': row[2], 'category': row[3]}
+
+# --- Device Checkout ---
+
+def is_valid_student_email(email):
+    return bool(email) and email.lower().endswith("gdst.net")
+
+def claim_devices(c, name, surname, email, device_ids, loan_time):
+    # The claim itself; runs inside the caller's write transaction (see checkout_devices)
+    numeric_ids = [int(d_id) for d_id in device_ids if str(d_id).isdigit()]
+    if not numeric_ids:
+        return []
+    placeholders = ", ".join("?" * len(numeric_ids))
+    c.execute(f"UPDATE devices SET available = 0 WHERE available = 1 AND id IN ({placeholders}) RETURNING id, rubric_id, suffix_id, category", numeric_ids)
+    claimed = c.fetchall()
+    if claimed:
+        c.execute("""INSERT INTO students (name, surname, email) VALUES (?, ?, ?)
+                     ON CONFLICT(email) DO UPDATE SET name = excluded.name, surname = excluded.surname
+                     RETURNING id""", (name, surname, email))
+        student_id = c.fetchone()[0]
+        c.executemany("INSERT INTO loans (student_id, device_id, loan_time, due_time) VALUES (?, ?, ?, ?)",
+                      [(student_id, r[0], loan_time, due_time_for(r[3], loan_time)) for r in claimed])
+        record_loan_stats(c, [r[0] for r in claimed], loan_time)
+    return claimed
+
+def return_device_loans(c, device_id, return_time):
+    # Closes the device's open loan (if any) and makes it loanable again; caller commits.
+    # Returns the (id, rubric_id, suffix_id, category) row of the device, or None if it wasn't on loan.
+    c.execute("UPDATE loans SET return_time = ? WHERE device_id = ? AND return_time IS NULL RETURNING device_id, loan_time", (return_time, device_id))
+    return _finish_returns(c, c.fetchall(), return_time)
+
+def return_loan(c, loan_id, return_time):
+    # Same as return_device_loans, for one loan by id (the kiosk return page). The
+    # return_time IS NULL guard means a loan closed concurrently elsewhere returns None.
+    c.execute("UPDATE loans SET return_time = ? WHERE id = ? AND return_time IS NULL RETURNING device_id, loan_time", (return_time, loan_id))
+    return _finish_returns(c, c.fetchall(), return_time)
+
+def _finish_returns(c, returned, return_time):
+    # Only a loan this statement actually closed may free its device or count in the stats
+    if not returned:
+        return None
+    c.execute("UPDATE devices SET available = 1 WHERE id = ? RETURNING id, rubric_id, suffix_id, category", (returned[0][0],))
+    device = c.fetchone()
+    record_return_stats(c, [(r[0], r[1], return_time) for r in returned])
+    return device
+
+def checkout_devices(conn, name, surname, email, device_ids, loan_time=None):
+    # Claims every requested device for one student in a single write transaction.
+    # BEGIN IMMEDIATE takes the write lock up front, and the conditional UPDATE only
+    # flips devices that are still available, so two kiosks racing for the same device
+    # can never both get it: whoever commits second simply doesn't see it in RETURNING.
+    # Returns (claimed rows as (id, rubric_id, suffix_id, category) in request order, ids that lost).
+    requested = list(dict.fromkeys(str(d_id) for d_id in device_ids))
+    loan_time = loan_time or datetime.now().isoformat()
+
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        claimed = claim_devices(c, name, surname, email, requested, loan_time)
+        if claimed:
+            conn.commit()
+        else:
+            conn.rollback()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    by_id = {str(r[0]): r for r in claimed}
+    loaned = [by_id[d_id] for d_id in requested if d_id in by_id]
+    lost = [d_id for d_id in requested if d_id not in by_id]
+    return loaned, lost
+
+# --- Scan Station ---
+# Barcode scanners post one device ID per scan to /scan. Device IDs are resolved through an
+# in-memory index (O(1), rebuilt only when the inventory itself changes), and the scans are
+# queued and group-committed: a worker thread applies everything that arrived within
+# SCAN_BATCH_WINDOW_MS in one write transaction, then acknowledges each scan individually.
+
+SCAN_BATCH_WINDOW_MS = 200
+SCAN_BATCH_MAX = 200
+SCAN_ACK_TIMEOUT_SECONDS = 10
+INVENTORY_EVENTS = {'device_added', 'device_deleted', 'reload'}
+
+_device_indexes = {}
+_inventory_versions = {}
+
+def normalise_device_id(full_id):
+    # Labels are printed as SHC-LQ-042 while rows display as SHC-LQ--042, so ignore dashes/case
+    return "".join(ch for ch in str(full_id).upper() if ch.isalnum())
+
+def invalidate_device_index(db_file=None):
+    db_file = db_file or current_db_file()
+    with _cache_lock:
+        _inventory_versions[db_file] = _inventory_versions.get(db_file, 0) + 1
+
+def lookup_device_id(full_id, db_file=None):
+    db_file = db_file or current_db_file()
+    if WORKER_PROCESSES > 1:
+        get_change_feed(db_file)  # starts the relay that invalidates the index on other workers' edits
+    version = _inventory_versions.get(db_file, 0)
+    entry = _device_indexes.get(db_file)
+    if entry is None or entry[0] != version:
+        index = {}
+        with pooled_connection(db_file) as conn:
+            for device_id, rubric_id, suffix_id in conn.execute("SELECT id, rubric_id, suffix_id FROM devices"):
+                key = normalise_device_id(f"{rubric_id}{suffix_id}")
+                index[key] = None if key in index else device_id  # None marks an ambiguous label
+        entry = _device_indexes[db_file] = (version, index)
+    return entry[1].get(normalise_device_id(full_id))
+
+class ScanBatcher:
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="scan-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, scan):
+        scan['future'] = Future()
+        self.queue.put(scan)
+        return scan['future']
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + SCAN_BATCH_WINDOW_MS / 1000
+            while len(batch) < SCAN_BATCH_MAX:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                events = self._apply(batch)
+            except Exception as e:
+                for scan in batch:
+                    scan['future'].set_exception(e)
+                continue
+            # The batch is committed, so answer the scanners before anything else can go wrong
+            for scan in batch:
+                scan['future'].set_result(scan['result'])
+            for event_type, data in events:
+                try:
+                    publish_change(event_type, self.db_file, **data)
+                except Exception as e:  # a lost event must not take the batcher thread down with it
+                    print(f"Scan station could not publish a {event_type} event: {e}", file=sys.stderr)
+
+    def _apply(self, batch):
+        now = datetime.now().isoformat()
+        returned, loans = [], {}
+        with pooled_connection(self.db_file) as conn:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                for scan in batch:
+                    if scan['action'] == 'return':
+                        device = return_device_loans(c, scan['device_pk'], now)
+                        if device:
+                            returned.append(feed_device(device))
+                            scan['result'] = ('returned', f"{device[1]}-{device[2]} returned.")
+                        else:
+                            scan['result'] = ('not_on_loan', "Device is not currently on loan.")
+                    else:
+                        claimed = claim_devices(c, scan['name'], scan['surname'], scan['email'], [scan['device_pk']], now)
+                        if claimed:
+                            student = f"{scan['name']} {scan['surname']}"
+                            loans.setdefault(student, []).append(feed_device(claimed[0]))
+                            scan['result'] = ('loaned', f"{claimed[0][1]}-{claimed[0][2]} loaned to {student}.")
+                        else:
+                            scan['result'] = ('unavailable', "Device is already on loan.")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        events = [('return', {'devices': returned})] if returned else []
+        events += [('loan', {'devices': devices, 'student': student}) for student, devices in loans.items()]
+        return events
+
+_scan_batchers = {}
+
+def get_scan_batcher(db_file=None):
+    db_file = db_file or current_db_file()
+    with _cache_lock:
+        batcher = _scan_batchers.get(db_file)
+        if batcher is None:
+            batcher = _scan_batchers[db_file] = ScanBatcher(db_file)
+        return batcher
+
+# --- Utilisation Analytics ---
+# Reports are answered from small rollup tables (stats_daily per day/category, stats_device
+# per device) that every loan and return updates in the same transaction, instead of
+# scanning and re-parsing the whole loans table. rebuild_stats() recomputes them from
+# history (migration, imports and the `flask backfill-stats` command).
+
+STATS_DEFAULT_WEEKS = 12
+_SQL_LOAN_SECONDS = "MAX(IFNULL((julianday({ret}) - julianday({loan})) * 86400, 0), 0)"
+
+def record_loan_stats(c, device_ids, loan_time):
+    c.executemany("""INSERT INTO stats_daily (day, category, loans) SELECT date(?), IFNULL(category, ''), 1 FROM devices WHERE id = ?
+                     ON CONFLICT(day, category) DO UPDATE SET loans = loans + 1""",
+                  [(loan_time, d_id) for d_id in device_ids])
+    c.executemany("""INSERT INTO stats_device (device_id, loans, last_loan_time) VALUES (?, 1, ?)
+                     ON CONFLICT(device_id) DO UPDATE SET loans = loans + 1, last_loan_time = MAX(IFNULL(last_loan_time, ''), excluded.last_loan_time)""",
+                  [(d_id, loan_time) for d_id in device_ids])
+
+def record_return_stats(c, returns):
+    # returns: (device_id, loan_time, return_time) for each loan that was just closed
+    seconds = _SQL_LOAN_SECONDS.format(ret="?", loan="?")
+    c.executemany(f"""INSERT INTO stats_daily (day, category, returns, loan_seconds)
+                      SELECT date(?), IFNULL(category, ''), 1, {seconds} FROM devices WHERE id = ?
+                      ON CONFLICT(day, category) DO UPDATE SET returns = returns + 1, loan_seconds = loan_seconds + excluded.loan_seconds""",
+                  [(ret, ret, loan, d_id) for d_id, loan, ret in returns])
+    c.executemany(f"""INSERT INTO stats_device (device_id, returns, loan_seconds) VALUES (?, 1, {seconds})
+                      ON CONFLICT(device_id) DO UPDATE SET returns = returns + 1, loan_seconds = loan_seconds + excluded.loan_seconds""",
+                  [(d_id, ret, loan) for d_id, loan, ret in returns])
+
+def rebuild_stats(c):
+    seconds = _SQL_LOAN_SECONDS.format(ret="l.return_time", loan="l.loan_time")
+    c.execute("DELETE FROM stats_daily")
+    c.execute("DELETE FROM stats_device")
+    c.execute("""INSERT INTO stats_daily (day, category, loans)
+                 SELECT date(l.loan_time) AS day, IFNULL(d.category, ''), COUNT(*) FROM loans l JOIN devices d ON l.device_id = d.id
+                 WHERE day IS NOT NULL GROUP BY 1, 2""")
+    c.execute(f"""INSERT INTO stats_daily (day, category, returns, loan_seconds)
+                  SELECT date(l.return_time) AS day, IFNULL(d.category, ''), COUNT(*), SUM({seconds}) FROM loans l JOIN devices d ON l.device_id = d.id
+                  WHERE day IS NOT NULL GROUP BY 1, 2
+                  ON CONFLICT(day, category) DO UPDATE SET returns = excluded.returns, loan_seconds = excluded.loan_seconds""")
+    c.execute(f"""INSERT INTO stats_device (device_id, loans, returns, loan_seconds, last_loan_time)
+                  SELECT l.device_id, COUNT(*), COUNT(l.return_time), SUM(CASE WHEN l.return_time IS NULL THEN 0 ELSE {seconds} END), MAX(l.loan_time)
+                  FROM loans l GROUP BY l.device_id""")
+
+def load_utilisation_stats(c, weeks=STATS_DEFAULT_WEEKS):
+    since = (datetime.now() - timedelta(weeks=weeks)).strftime("%Y-%m-%d")
+    c.execute("""SELECT strftime('%Y-W%W', day) AS week, category, SUM(loans), SUM(returns) FROM stats_daily
+                 WHERE day >= ? GROUP BY week, category ORDER BY week DESC, category""", (since,))
+    weekly = [{'week': r[0], 'category': r[1], 'loans': r[2], 'returns': r[3]} for r in c.fetchall()]
+
+    c.execute("""SELECT category, SUM(loans), SUM(returns), SUM(loan_seconds) FROM stats_daily
+                 GROUP BY category ORDER BY category""")
+    categories = [{'category': r[0], 'loans': r[1], 'returns': r[2],
+                   'avg_loan_hours': round(r[3] / r[2] / 3600, 1) if r[2] else None} for r in c.fetchall()]
+
+    # A range scan of idx_loans_due, which only holds open loans
+    c.execute("""SELECT d.category, COUNT(*) FROM loans l JOIN devices d ON l.device_id = d.id
+                 WHERE l.return_time IS NULL AND l.due_time < ? GROUP BY d.category ORDER BY d.category""",
+              (datetime.now().isoformat(timespec='seconds'),))
+    overdue = [{'category': r[0], 'count': r[1]} for r in c.fetchall()]
+
+    c.execute("""SELECT d.id, d.rubric_id, d.suffix_id, d.category, sd.loans, sd.last_loan_time FROM stats_device sd
+                 JOIN devices d ON d.id = sd.device_id ORDER BY sd.loans DESC LIMIT 10""")
+    top_devices = [{'id': r[0], 'full_id': f"{r[1]}-{r[2]}", 'category': r[3], 'loans': r[4],
+                    'last_loaned': "{} {}".format(*format_dt(r[5]))} for r in c.fetchall()]
+
+    return {'weeks': weeks, 'weekly': weekly,
+            'categories': categories, 'overdue': overdue, 'top_devices': top_devices}
+
+@app.cli.command("backfill-stats")
+def backfill_stats_command():
+    """Rebuild the utilisation rollup tables from the full loan history (every site)."""
+    for site, db_file in iter_sites():
+        init_db(db_file)
+        conn = sqlite3.connect(db_file)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            rebuild_stats(conn.cursor())
+            conn.commit()
+        finally:
+            conn.close()
+        bump_data_generation(db_file)
+        print(f"Utilisation statistics rebuilt{f' for {site}' if site else ''}.")
+
+# --- Cross-Site Reports ---
+# Reports over every site fan out to the shards on a small thread pool (sqlite3 releases
+# the GIL while a query runs, so the shards really are read in parallel) and the per-site
+# results are merged here. Each shard is read inside one transaction so its figures agree
+# with each other, and a shard that fails is reported as such instead of failing the page.
+
+SITE_REPORT_WORKERS = 8
+SITE_SUMMARY_COUNTS = ('devices', 'on_loan', 'overdue', 'students', 'recent_loans')
+_site_report_pool = ThreadPoolExecutor(max_workers=SITE_REPORT_WORKERS, thread_name_prefix="site-report")
+
+def _read_shard(db_file, loader, args):
+    with pooled_connection(db_file) as conn:
+        conn.execute("BEGIN")
+        try:
+            return loader(conn.cursor(), *args)
+        finally:
+            conn.rollback()
+
+def fan_out(loader, *args):
+    """Runs loader(c, *args) on every site's shard at once; returns {site: result, or the sqlite3.Error}."""
+    futures = {site: _site_report_pool.submit(_read_shard, db_file, loader, args) for site, db_file in iter_sites()}
+    results = {}
+    for site, future in futures.items():
+        try:
+            results[site] = future.result()
+        except sqlite3.Error as e:
+            results[site] = e
+    return results
+
+def load_site_summary(c, weeks=STATS_DEFAULT_WEEKS):
+    since = (datetime.now() - timedelta(weeks=weeks)).strftime("%Y-%m-%d")
+    c.execute("""SELECT (SELECT COUNT(*) FROM devices), (SELECT COUNT(*) FROM devices WHERE available = 0),
+                        (SELECT COUNT(*) FROM loans WHERE return_time IS NULL AND due_time < ?),
+                        (SELECT COUNT(*) FROM students), (SELECT IFNULL(SUM(loans), 0) FROM stats_daily WHERE day >= ?)""",
+              (datetime.now().isoformat(timespec='seconds'), since))
+    summary = dict(zip(SITE_SUMMARY_COUNTS, c.fetchone()))
+    c.execute("SELECT category, SUM(loans), SUM(returns), SUM(loan_seconds) FROM stats_daily GROUP BY category")
+    summary['categories'] = c.fetchall()
+    return summary
+
+def load_cross_site_report(weeks=STATS_DEFAULT_WEEKS):
+    sites, totals, categories = [], dict.fromkeys(SITE_SUMMARY_COUNTS, 0), {}
+    for site, summary in fan_out(load_site_summary, weeks).items():
+        if isinstance(summary, sqlite3.Error):
+            sites.append({'site': site, 'error': str(summary)})
+            continue
+        sites.append({'site': site, **{key: summary[key] for key in SITE_SUMMARY_COUNTS}})
+        for key in SITE_SUMMARY_COUNTS:
+            totals[key] += summary[key]
+        for category, loans, returns, seconds in summary['categories']:
+            merged = categories.setdefault(category, [0, 0, 0])
+            merged[0] += loans
+            merged[1] += returns
+            merged[2] += seconds
+    categories = [{'category': category, 'loans': loans, 'returns': returns,
+                   'avg_loan_hours': round(seconds / returns / 3600, 1) if returns else None}
+                  for category, (loans, returns, seconds) in sorted(categories.items())]
+    return {'weeks': weeks, 'sites': sites, 'totals': totals, 'categories': categories}
+
+# --- Overdue Loans ---
+# Every loan gets a due_time on checkout from its category's loan period. The overdue job
+# range-scans idx_loans_due for open loans past due that have no reminder_log entry yet,
+# renders one message per student covering all of their overdue devices into the
+# reminder_outbox table (in the same transaction as the log entries), and then writes
+# each new message out as an .eml file for the mail client or relay to pick up.
+
+LOAN_PERIOD_DAYS = {
+    'Laptop': 7, 'iPad': 7, 'Headphones': 7, 'Trips': 14, 'Other': 7,
+    'Charger': 1, 'iPad Charger': 1, 'USBC Charger': 1,
+}
+DEFAULT_LOAN_PERIOD_DAYS = 7
+REMINDER_DIR = "outbox"
+REMINDER_FROM = os.environ.get("REMINDER_FROM", "device-loans@localhost")
+OVERDUE_CHECK_MINUTES = 60
+
+def due_time_for(category, loan_time):
+    days = LOAN_PERIOD_DAYS.get(category, DEFAULT_LOAN_PERIOD_DAYS)
+    return (datetime.fromisoformat(loan_time) + timedelta(days=days)).isoformat(timespec='seconds')
+
+def backfill_due_times(c):
+    # SQL twin of due_time_for, for loans recorded without one (older rows, merges, seeding)
+    cases = " ".join("WHEN ? THEN ?" for _ in LOAN_PERIOD_DAYS)
+    params = [value for item in LOAN_PERIOD_DAYS.items() for value in item] + [DEFAULT_LOAN_PERIOD_DAYS]
+    c.execute(f"""UPDATE loans SET due_time = strftime('%Y-%m-%dT%H:%M:%S', loan_time, '+' || COALESCE(
+                      (SELECT CASE d.category {cases} ELSE ? END FROM devices d WHERE d.id = loans.device_id), ?) || ' days')
+                  WHERE due_time IS NULL""", params + [DEFAULT_LOAN_PERIOD_DAYS])
+
+def queue_overdue_reminders(conn, now=None):
+    """Renders reminders for newly overdue loans into the outbox; returns (messages, loans)."""
+    now = (now or datetime.now()).isoformat(timespec='seconds')
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("""SELECT l.id, l.loan_time, l.due_time, s.name, s.surname, s.email, d.rubric_id, d.suffix_id, d.category
+                     FROM loans l JOIN students s ON s.id = l.student_id JOIN devices d ON d.id = l.device_id
+                     WHERE l.return_time IS NULL AND l.due_time < ?
+                       AND NOT EXISTS (SELECT 1 FROM reminder_log r WHERE r.loan_id = l.id)
+                     ORDER BY s.email, l.due_time""", (now,))
+        by_student = {}
+        for r in c.fetchall():
+            student = by_student.setdefault(r[5], {'name': r[3], 'surname': r[4], 'email': r[5], 'loans': []})
+            student['loans'].append({'id': r[0], 'full_id': f"{r[6]}-{r[7]}", 'category': r[8],
+                                     'loan_date': format_dt(r[1])[0], 'due_date': "{} {}".format(*format_dt(r[2]))})
+
+        with app.app_context():
+            for student in by_student.values():
+                subject = ("Overdue device: " + student['loans'][0]['full_id'] if len(student['loans']) == 1
+                           else f"{len(student['loans'])} overdue devices")
+                body = render_template("reminder_email.txt", student=student)
+                c.execute("""INSERT INTO reminder_outbox (recipient, subject, body, created_time)
+                             VALUES (?, ?, ?, ?) RETURNING id""", (student['email'], subject, body, now))
+                reminder_id = c.fetchone()[0]
+                c.executemany("INSERT OR IGNORE INTO reminder_log (loan_id, reminder_id, sent_time) VALUES (?, ?, ?)",
+                              [(loan['id'], reminder_id, now) for loan in student['loans']])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(by_student), sum(len(student['loans']) for student in by_student.values())
+
+def write_reminder_files(conn, folder=REMINDER_DIR):
+    """Writes outbox messages that don't have an .eml file yet; returns how many were written."""
+    rows = conn.execute("""SELECT id, recipient, subject, body, created_time FROM reminder_outbox
+                           WHERE written_time IS NULL ORDER BY id""").fetchall()
+    if not rows:
+        return 0
+    os.makedirs(folder, exist_ok=True)
+    for reminder_id, recipient, subject, body, created_time in rows:
+        message = EmailMessage()
+        message['From'] = REMINDER_FROM
+        message['To'] = recipient
+        message['Subject'] = subject
+        message['Date'] = format_datetime(datetime.fromisoformat(created_time).astimezone())
+        message['Message-ID'] = make_msgid(f"reminder-{reminder_id}")
+        message.set_content(body)
+        path = os.path.join(folder, f"reminder-{reminder_id:06d}.eml")
+        with open(path + ".tmp", "wb") as f:
+            f.write(bytes(message))
+        os.replace(path + ".tmp", path)
+    # A crash before this commit only means the same files get written again next run
+    written_time = datetime.now().isoformat(timespec='seconds')
+    conn.executemany("UPDATE reminder_outbox SET written_time = ? WHERE id = ?", [(written_time, row[0]) for row in rows])
+    conn.commit()
+    return len(rows)
+
+def reminder_folder(site=None):
+    # Outbox ids are per shard, so each site writes to its own folder
+    return os.path.join(REMINDER_DIR, site) if site else REMINDER_DIR
+
+def run_overdue_job(db_file=None, now=None, folder=REMINDER_DIR):
+    with pooled_connection(db_file) as conn:
+        messages, loans = queue_overdue_reminders(conn, now)
+        written = write_reminder_files(conn, folder)
+    return messages, loans, written
+
+def start_overdue_scheduler(db_file=None, interval_minutes=OVERDUE_CHECK_MINUTES, folder=REMINDER_DIR):
+    if interval_minutes <= 0:
+        return None
+    db_file = db_file or current_db_file()
+
+    def run():
+        while True:
+            try:
+                run_overdue_job(db_file, folder=folder)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Overdue reminder job failed: {e}", file=sys.stderr)
+            time.sleep(interval_minutes * 60)
+
+    thread = threading.Thread(target=run, name="overdue-scheduler", daemon=True)
+    thread.start()
+    return thread
+
+@app.cli.command("send-reminders")
+def send_reminders_command():
+    """Queue reminders for overdue loans and write any unwritten ones to the outbox folder (every site)."""
+    for site, db_file in iter_sites():
+        init_db(db_file)
+        messages, loans, written = run_overdue_job(db_file, folder=reminder_folder(site))
+        print(f"{site + ': ' if site else ''}Queued {messages} reminder(s) covering {loans} overdue loan(s); "
+              f"wrote {written} file(s) to {reminder_folder(site)}/.")
+
+# --- Admin Dashboard Pagination ---
+# The admin tables are paged with keyset (seek) pagination: each page continues from the
+# sort-key values of the previous page's last row instead of using OFFSET, so fetching
+# page 200 costs the same as page 1. Every sort key lists its ORDER BY expressions and the
+# table's row id is appended as a tiebreaker, which makes (keys..., id) unique.
+
+ADMIN_PAGE_SIZE = 50
+
+# Nullable columns are sorted through IFNULL(): a row-value seek past a NULL key is itself
+# NULL and would silently drop every later row. The history sorts by student or device run
+# student/device first (by the idx_*_sort_* expression indexes) and then that one's loans by
+# loan time, which idx_loans_student_time/idx_loans_device_time already provide in order.
+# Status sorts by return time too (open loans are '' and so group together): a two-valued
+# key can't be seeked into, so a deep page would rescan the whole "Returned" group.
+_STUDENT_NAME_KEYS = ["IFNULL(s.surname, '')", "IFNULL(s.name, '')"]
+_DEVICE_ID_KEYS = ["IFNULL(d.rubric_id, '')", "IFNULL(d.suffix_id, '')"]
+inventory_sort_cols = {'id': ['d.id'], 'rubric_id': _DEVICE_ID_KEYS, 'suffix_id': ["IFNULL(d.suffix_id, '')"], 'category': ["IFNULL(d.category, '')"], 'available': ['IFNULL(d.available, 0)']}
+on_loan_sort_cols = {'device_id_loan': _DEVICE_ID_KEYS, 'category_loan': ["IFNULL(d.category, '')", "IFNULL(s.surname, '')"], 'student_name_loan': _STUDENT_NAME_KEYS, 'student_email_loan': ["IFNULL(s.email, '')"]}
+history_sort_cols = {'student_name_history': _STUDENT_NAME_KEYS + ['s.id', 'l.loan_time'], 'device_id_history': _DEVICE_ID_KEYS + ['d.id', 'l.loan_time'],
+                     'loan_time_history': ['l.loan_time'], 'return_time_history': ["IFNULL(l.return_time, '')"], 'status_history': ["IFNULL(l.return_time, '')"]}
+
+def _format_inventory_row(r):
+    return {'id': r[0], 'full_id': f"{r[1]}-{r[2]}", 'rubric_id': r[1], 'suffix_id': r[2], 'category': r[3], 'available': r[4], 'has_notes': bool(r[5])}
+
+def _format_on_loan_row(r):
+    due_date, due_time = format_dt(r[7])
+    return {'full_id': f"{r[0]}-{r[1]}", 'category': r[2], 'name': r[3], 'surname': r[4], 'email': r[5], 'device_id': r[6],
+            'due': f"{due_date} {due_time}" if r[7] else None, 'overdue': bool(r[7]) and r[7] < datetime.now().isoformat()}
+
+def _format_history_row(r):
+    loan_date, loan_time = format_dt(r[4])
+    return_date, return_time = format_dt(r[5])
+    return {'student_name': f"{r[0]} {r[1]}", 'device_id': f"{r[2]}-{r[3]}", 'loan_date': loan_date, 'loan_time': loan_time,
+            'return_date': return_date, 'return_time': return_time, 'status': "Returned" if r[5] else "On Loan"}
+
+ADMIN_TABLES = {
+    'inventory': {
+        'query': "SELECT d.id, d.rubric_id, d.suffix_id, d.category, d.available, d.notes{keys} FROM devices d {where}",
+        'filters': [], 'id_col': 'd.id', 'sort_cols': inventory_sort_cols,
+        'default_sort': ('id', 'desc'), 'format': _format_inventory_row,
+    },
+    'on_loan': {
+        'query': "SELECT d.rubric_id, d.suffix_id, d.category, s.name, s.surname, s.email, d.id, l.due_time{keys} FROM devices d JOIN loans l ON d.id = l.device_id JOIN students s ON l.student_id = s.id {where}",
+        'filters': ["d.available = 0", "l.return_time IS NULL"], 'id_col': 'l.id', 'sort_cols': on_loan_sort_cols,
+        'default_sort': ('category_loan', 'asc'), 'format': _format_on_loan_row,
+    },
+    'history': {
+        'query': "SELECT s.name, s.surname, d.rubric_id, d.suffix_id, l.loan_time, l.return_time{keys} FROM loans l JOIN students s ON l.student_id = s.id JOIN devices d ON l.device_id = d.id {where}",
+        'filters': [], 'id_col': 'l.id', 'sort_cols': history_sort_cols,
+        'default_sort': ('loan_time_history', 'desc'), 'format': _format_history_row,
+    },
+}
+
+def encode_page_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_page_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid page cursor.")
+    if not isinstance(values, list) or not all(v is None or isinstance(v, (str, int, float)) for v in values):
+        raise ValueError("Invalid page cursor.")
+    return values
+
+def resolve_admin_sort(table, sort_by, sort_dir):
+    spec = ADMIN_TABLES[table]
+    if sort_by not in spec['sort_cols']:
+        return spec['default_sort']
+    return sort_by, (sort_dir.lower() if sort_dir and sort_dir.lower() in ('asc', 'desc') else 'desc')
+
+def fetch_admin_page(c, table, sort_by=None, sort_dir=None, cursor=None, limit=ADMIN_PAGE_SIZE):
+    spec = ADMIN_TABLES[table]
+    sort_by, sort_dir = resolve_admin_sort(table, sort_by, sort_dir)
+    keys = list(spec['sort_cols'][sort_by])
+    if spec['id_col'] not in keys:
+        keys.append(spec['id_col'])
+
+    filters, params = list(spec['filters']), []
+    if cursor:
+        values = decode_page_cursor(cursor)
+        if len(values) != len(keys):
+            raise ValueError("Invalid page cursor.")
+        # Row-value comparison seeks straight past the last row that was already sent. SQLite
+        # can't range-scan an expression index with it, and only checks it once every key's
+        # table is joined, so each shorter prefix (which it implies) is bounded as well: the
+        # first key becomes an index range, and a student/device prefix skips that row's loans.
+        op = '<' if sort_dir == 'desc' else '>'
+        for n in range(1, len(keys)):
+            filters.append(f"({', '.join(keys[:n])}) {op}= ({', '.join('?' * n)})")
+            params.extend(values[:n])
+        filters.append(f"({', '.join(keys)}) {op} ({', '.join('?' * len(keys))})")
+        params.extend(values)
+
+    where = f"WHERE {' AND '.join(filters)}" if filters else ""
+    order_by = ", ".join(f"{k} {sort_dir.upper()}" for k in keys)
+    sql = spec['query'].format(keys=", " + ", ".join(keys), where=where) + f" ORDER BY {order_by} LIMIT ?"
+    c.execute(sql, (*params, limit + 1))
+    raw = c.fetchall()
+
+    has_more = len(raw) > limit
+    raw = raw[:limit]
+    width = len(raw[0]) - len(keys) if raw else 0
+    rows = [spec['format'](r[:width]) for r in raw]
+    next_cursor = encode_page_cursor(list(raw[-1][width:])) if has_more else None
+    return rows, next_cursor, sort_by, sort_dir
+
+# --- Admin Search ---
+# Devices and students are matched through their FTS5 indexes and ranked with bm25; loans
+# match when their device or student does and are listed newest first, paged by keyset.
+# Every search term is a prefix, so "amel smi" finds Amelia Smith and "shc-lq-04" finds
+# SHC-LQ--042.
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_SECTIONS = ('devices', 'students', 'loans')
+
+def build_search_query(text, device_columns=False):
+    terms = []
+    for word in text.split()[:10]:
+        parts = re.findall(r"[^\W_]+", word)
+        if not parts:
+            continue
+        term = '"' + " ".join(parts) + '"*'
+        if device_columns:
+            term = f'({term} OR device_key : "{normalise_device_id(word)}"*)'
+        terms.append(term)
+    return " AND ".join(terms) or None
+
+def _search_offset(cursor):
+    if not cursor:
+        return 0
+    values = decode_page_cursor(cursor)
+    if len(values) != 1 or not isinstance(values[0], int) or values[0] < 0:
+        raise ValueError("Invalid page cursor.")
+    return values[0]
+
+def search_devices(c, text, cursor=None, limit=SEARCH_PAGE_SIZE):
+    match = build_search_query(text, device_columns=True)
+    if not match:
+        return [], None
+    offset = _search_offset(cursor)
+    # Rank and cut the page first, so only the rows shown get joined to their borrowers
+    c.execute("""SELECT d.id, d.rubric_id, d.suffix_id, d.category, d.available, d.notes, s.name, s.surname, s.email
+                 FROM (SELECT rowid, bm25(search_devices, 10.0, 10.0, 2.0, 1.0) AS score FROM search_devices
+                       WHERE search_devices MATCH ? ORDER BY score, rowid LIMIT ? OFFSET ?) f
+                 JOIN devices d ON d.id = f.rowid
+                 LEFT JOIN loans l ON l.device_id = d.id AND l.return_time IS NULL
+                 LEFT JOIN students s ON s.id = l.student_id
+                 ORDER BY f.score, f.rowid""", (match, limit + 1, offset))
+    raw = c.fetchall()
+    rows = [{**_format_inventory_row(r[:6]), 'notes': r[5], 'borrower': f"{r[6]} {r[7]}" if r[6] is not None else None,
+             'borrower_email': r[8]} for r in raw[:limit]]
+    return rows, encode_page_cursor([offset + limit]) if len(raw) > limit else None
+
+def search_students(c, text, cursor=None, limit=SEARCH_PAGE_SIZE):
+    match = build_search_query(text)
+    if not match:
+        return [], None
+    offset = _search_offset(cursor)
+    c.execute("""SELECT st.id, st.name, st.surname, st.email,
+                        (SELECT COUNT(*) FROM loans l WHERE l.student_id = st.id AND l.return_time IS NULL),
+                        (SELECT COUNT(*) FROM loans l WHERE l.student_id = st.id)
+                 FROM (SELECT rowid, bm25(search_students, 5.0, 5.0, 1.0) AS score FROM search_students
+                       WHERE search_students MATCH ? ORDER BY score, rowid LIMIT ? OFFSET ?) f
+                 JOIN students st ON st.id = f.rowid
+                 ORDER BY f.score, f.rowid""", (match, limit + 1, offset))
+    raw = c.fetchall()
+    rows = [{'id': r[0], 'name': r[1], 'surname': r[2], 'email': r[3], 'active_loans': r[4], 'total_loans': r[5]} for r in raw[:limit]]
+    return rows, encode_page_cursor([offset + limit]) if len(raw) > limit else None
+
+def search_loans(c, text, cursor=None, limit=SEARCH_PAGE_SIZE):
+    device_match = build_search_query(text, device_columns=True)
+    student_match = build_search_query(text)
+    if not device_match:
+        return [], None
+    # Narrow matches (one student, a few devices): read their loans through the per-device and
+    # per-student indexes and sort them. Broad ones ("laptop"): walk the whole history newest
+    # first and stop at a page of hits, which takes about limit / share rows, where share is
+    # the fraction of devices and students that matched.
+    matched_devices, total_devices, matched_students, total_students, total_loans = c.execute(
+        """SELECT (SELECT COUNT(*) FROM search_devices WHERE search_devices MATCH ?), (SELECT COUNT(*) FROM devices),
+                  (SELECT COUNT(*) FROM search_students WHERE search_students MATCH ?), (SELECT COUNT(*) FROM students),
+                  (SELECT IFNULL(MAX(id), 0) FROM loans)""", (device_match, student_match)).fetchone()
+    if not matched_devices and not matched_students:
+        return [], None
+    share = matched_devices / max(total_devices, 1) + matched_students / max(total_students, 1)
+    scan_history = share * share * total_loans > limit
+
+    where, params = "", [device_match, student_match]
+    if cursor:
+        values = decode_page_cursor(cursor)
+        if len(values) != 2:
+            raise ValueError("Invalid page cursor.")
+        where, params = "AND (l.loan_time, l.id) < (?, ?)", params + values
+    c.execute(f"""SELECT s.name, s.surname, d.rubric_id, d.suffix_id, l.loan_time, l.return_time, l.id
+                  FROM loans l {"INDEXED BY idx_loans_loan_time" if scan_history else ""}
+                  JOIN students s ON s.id = l.student_id JOIN devices d ON d.id = l.device_id
+                  WHERE ({"+" if scan_history else ""}l.device_id IN (SELECT rowid FROM search_devices WHERE search_devices MATCH ?)
+                      OR {"+" if scan_history else ""}l.student_id IN (SELECT rowid FROM search_students WHERE search_students MATCH ?))
+                  {where}
+                  ORDER BY l.loan_time DESC, l.id DESC LIMIT ?""", params + [limit + 1])
+    raw = c.fetchall()
+    rows = [_format_history_row(r) for r in raw[:limit]]
+    return rows, encode_page_cursor([raw[limit - 1][4], raw[limit - 1][6]]) if len(raw) > limit else None
+
+SEARCHERS = {'devices': search_devices, 'students': search_students, 'loans': search_loans}
+
 # --- Routes ---
 
 @app.route("/")
@@ -89,7 +1429,9 @@ def login():
     if request.method == "POST":
         username = request.form.get("username")
         password = request.form.get("password")
-        if username == ADMIN_USERNAME and password == ADMIN_PASSWORD:
+        with pooled_connection(DB_FILE) as conn:  # one admin login for every site
+            valid = check_admin_login(conn.cursor(), username, password)
+        if valid:
             session['logged_in'] = True
             flash("Logged in successfully!", "success")
             return redirect(url_for("admin"))
@@ -114,66 +1456,44 @@ def loan():
         email = request.form.get("email")
         device_ids_str = request.form.get("selected_device_ids") 
 
-        if not email or not email.lower().endswith("gdst.net"):
+        if not is_valid_student_email(email):
             flash("Invalid email address. Please use a valid GDST email.", "error")
-            conn.close()
             return redirect(url_for("loan"))
         
         if not device_ids_str:
             flash("Please select at least one device before attempting to loan.", "error")
-            conn.close()
             return redirect(url_for("loan"))
 
         device_ids = [d_id.strip() for d_id in device_ids_str.split(',') if d_id.strip()]
 
         try:
-            c.execute("SELECT id FROM students WHERE email = ?", (email,))
-            student_row = c.fetchone()
-            if student_row:
-                student_id = student_row[0]
-                c.execute("UPDATE students SET name = ?, surname = ? WHERE id = ?", (name, surname, student_id))
-            else:
-                c.execute("INSERT INTO students (name, surname, email) VALUES (?, ?, ?)", (name, surname, email))
-                student_id = c.lastrowid
-
-            loaned_successfully = []
-            
-            for d_id in device_ids:
-                c.execute("SELECT available, rubric_id, suffix_id FROM devices WHERE id = ?", (d_id,))
-                device_info = c.fetchone()
-
-                if device_info and device_info[0] == 1:
-                    loan_time = datetime.now().isoformat()
-                    c.execute("INSERT INTO loans (student_id, device_id, loan_time) VALUES (?, ?, ?)", 
-                              (student_id, d_id, loan_time))
-                    c.execute("UPDATE devices SET available = 0 WHERE id = ?", (d_id,))
-                    full_id = f"{device_info[1]}{device_info[2]}"
-                    loaned_successfully.append(full_id)
-                else:
-                    flash(f"Warning: Device {d_id} was already taken or doesn't exist. Skipping.", "error")
+            loaned, lost = checkout_devices(conn, name, surname, email, device_ids)
+            for d_id in lost:
+                flash(f"Warning: Device {d_id} was already taken or doesn't exist. Skipping.", "error")
 
-            if loaned_successfully:
-                conn.commit()
-                devices_list = ", ".join(loaned_successfully)
+            if loaned:
+                publish_change('loan', devices=[feed_device(r) for r in loaned], student=f"{name} {surname}")
+                devices_list = ", ".join(f"{r[1]}{r[2]}" for r in loaned)
                 flash(f"Successfully loaned: {devices_list} to {name}!", "success")
             else:
-                conn.rollback()
                 flash("No devices were loaned. Please try again.", "error")
 
         except sqlite3.Error as e:
             flash(f"Database Error: {e}", "error")
-            conn.rollback()
-        finally:
-            conn.close()
         return redirect(url_for("loan"))
 
     else:
-        c.execute("SELECT id, rubric_id, suffix_id, category FROM devices WHERE available = 1")
-        devices = c.fetchall()
-        c.execute("SELECT DISTINCT category FROM devices")
-        categories = [row[0] for row in c.fetchall()]
-        conn.close()
-        return render_template("loan.html", devices=devices, categories=categories)
+        def load_available():
+            c.execute("SELECT id, rubric_id, suffix_id, category FROM devices WHERE available = 1 ORDER BY id")
+            devices = c.fetchall()
+            c.execute("SELECT DISTINCT category FROM devices")
+            categories = [row[0] for row in c.fetchall()]
+            return devices, categories
+
+        def render():
+            devices, categories = cached_page_data('loan', load_available)
+            return render_template("loan.html", devices=devices, categories=categories)
+        return conditional_page(render)
     
 @app.route("/return", methods=["GET", "POST"])
 def return_device():
@@ -183,58 +1503,68 @@ def return_device():
         loan_id = request.form.get("loan_id")
         category_filter = request.form.get('category_filter')
         try:
-            c.execute("SELECT device_id FROM loans WHERE id = ?", (loan_id,))
-            loan_info = c.fetchone()
-            if not loan_info:
-                flash("Error: Could not find the specified loan.", "error")
-                conn.rollback()
-            else:
-                device_id = loan_info[0]
-                return_time = datetime.now().isoformat()
-                c.execute("UPDATE loans SET return_time = ? WHERE id = ?", (return_time, loan_id))
-                c.execute("UPDATE devices SET available = 1 WHERE id = ?", (device_id,))
+            c.execute("BEGIN IMMEDIATE")
+            device = return_loan(c, loan_id, datetime.now().isoformat())
+            if device:
                 conn.commit()
+                publish_change('return', devices=[feed_device(device)])
                 flash(f"Device returned successfully!", "success")
+            else:
+                c.execute("SELECT 1 FROM loans WHERE id = ?", (loan_id,))
+                if c.fetchone():
+                    flash("This loan has already been returned.", "error")
+                else:
+                    flash("Error: Could not find the specified loan.", "error")
+                conn.rollback()
         except sqlite3.Error as e:
             flash(f"Database Error: {e}", "error")
             conn.rollback()
-        finally:
-            conn.close()
 
         if category_filter:
             return redirect(url_for("return_device", category=category_filter))
         return redirect(url_for("return_device"))
     else:
         category_filter = request.args.get('category', None)
-        query = """
-            SELECT l.id, d.rubric_id, d.suffix_id, s.name, s.surname, d.category
-            FROM loans l
-            JOIN devices d ON l.device_id = d.id
-            JOIN students s ON l.student_id = s.id
-            WHERE l.return_time IS NULL
-        """
-        params = []
-        if category_filter:
-            query += " AND d.category = ?"
-            params.append(category_filter)
-
-        query += " ORDER BY s.surname, s.name"
-        c.execute(query, tuple(params))
-        active_loans = c.fetchall()
-        c.execute("""
-            SELECT DISTINCT d.category
-            FROM devices d
-            JOIN loans l ON d.id = l.device_id
-            WHERE l.return_time IS NULL
-            ORDER BY d.category
-        """)
-        loaned_categories = [row[0] for row in c.fetchall()]
 
-        conn.close()
-        return render_template("return.html", 
-                               active_loans=active_loans, 
-                               categories=loaned_categories, 
-                               active_category=category_filter)
+        def load_active_loans():
+            query = """
+                SELECT l.id, d.rubric_id, d.suffix_id, s.name, s.surname, d.category
+                FROM loans l
+                JOIN devices d ON l.device_id = d.id
+                JOIN students s ON l.student_id = s.id
+                WHERE l.return_time IS NULL
+            """
+            params = []
+            if category_filter:
+                query += " AND d.category = ?"
+                params.append(category_filter)
+
+            query += " ORDER BY s.surname, s.name"
+            c.execute(query, tuple(params))
+            return c.fetchall()
+
+        def load_loaned_categories():
+            c.execute("""
+                SELECT DISTINCT d.category
+                FROM devices d
+                JOIN loans l ON d.id = l.device_id
+                WHERE l.return_time IS NULL
+                ORDER BY d.category
+            """)
+            return [row[0] for row in c.fetchall()]
+
+        def render():
+            categories = cached_page_data('loaned_categories', load_loaned_categories)
+            # ?category= is free text, so only categories with loans get a cache entry of their own
+            if not category_filter or category_filter in categories:
+                active_loans = cached_page_data(('active_loans', category_filter), load_active_loans)
+            else:
+                active_loans = load_active_loans()
+            return render_template("return.html", 
+                                   active_loans=active_loans, 
+                                   categories=categories, 
+                                   active_category=category_filter)
+        return conditional_page(render)
 
 
 @app.route("/admin", methods=["GET", "POST"])
@@ -247,20 +1577,17 @@ def admin():
         if "active_return_id" in request.form:
             active_return_id_full = request.form.get("active_return_id")
             try:
-                parts = active_return_id_full.split('-')
-                rubric_id = "-".join(parts[:-1]) if len(parts) > 2 else parts[0]
-                suffix_id = parts[-1]
-                c.execute("SELECT id FROM devices WHERE rubric_id = ? AND suffix_id = ?", (rubric_id, suffix_id))
-                device_row = c.fetchone()
-                if not device_row:
+                device_id = lookup_device_id(active_return_id_full)
+                if not device_id:
                     flash(f"Error: Could not find device with ID {active_return_id_full}.", "error")
                 else:
-                    device_id = device_row[0]
-                    return_time = datetime.now().isoformat()
-                    c.execute("UPDATE loans SET return_time = ? WHERE device_id = ? AND return_time IS NULL", (return_time, device_id))
-                    c.execute("UPDATE devices SET available = 1 WHERE id = ?", (device_id,))
+                    device = return_device_loans(c, device_id, datetime.now().isoformat())
                     conn.commit()
-                    flash(f"Device {active_return_id_full} marked as handed in successfully!", "success")
+                    if device:
+                        publish_change('return', devices=[feed_device(device)])
+                        flash(f"Device {active_return_id_full} marked as handed in successfully!", "success")
+                    else:
+                        flash(f"Device {active_return_id_full} is not currently on loan.", "error")
             except (sqlite3.Error, ValueError) as e:
                 flash(f"Error processing return: {e}", "error")
                 conn.rollback()
@@ -276,6 +1603,7 @@ def admin():
                 else:
                     c.execute("DELETE FROM devices WHERE id = ?", (delete_id,))
                     conn.commit()
+                    publish_change('device_deleted', devices=[{'id': int(delete_id)}] if str(delete_id).isdigit() else [])
                     flash(f"Device ID {delete_id} deleted successfully!", "success")
             except sqlite3.Error as e:
                 flash(f"Error deleting device: {e}", "error")
@@ -292,53 +1620,195 @@ def admin():
                     try:
                         c.execute("INSERT INTO devices (rubric_id, suffix_id, category, available) VALUES (?, ?, ?, 1)", (rubric_id, suffix_id, category))
                         conn.commit()
+                        publish_change('device_added', devices=[feed_device((c.lastrowid, rubric_id, suffix_id, category))])
                         flash("Device added successfully!", "success")
                     except sqlite3.Error as e:
                         conn.rollback()
                         flash(f"Error adding device: {e}", "error")
         
-        conn.close()
         return redirect(url_for("admin"))
     else:
         sort_by = request.args.get('sort_by', 'id') 
         sort_dir = request.args.get('sort_dir', 'desc')
         if sort_dir.lower() not in ['asc', 'desc']: sort_dir = 'desc'
 
-        inventory_sort_cols = {'id': 'id', 'rubric_id': 'rubric_id', 'suffix_id': 'suffix_id', 'category': 'category', 'available': 'available'}
-        on_loan_sort_cols = {'device_id_loan': 'd.rubric_id', 'category_loan': 'd.category', 'student_name_loan': 's.surname', 'student_email_loan': 's.email'}
-        history_sort_cols = {'student_name_history': 's.surname', 'device_id_history': 'd.rubric_id', 'loan_time_history': 'l.loan_time', 'return_time_history': 'l.return_time', 'status_history': 'l.return_time IS NULL'}
-
-        inventory_order_by, on_loan_order_by, history_order_by = "ORDER BY id DESC", "ORDER BY d.category, s.surname", "ORDER BY l.loan_time DESC"
-
-        if sort_by in inventory_sort_cols:
-            inventory_order_by = f"ORDER BY {inventory_sort_cols[sort_by]} {sort_dir.upper()}"
-        elif sort_by in on_loan_sort_cols:
-            sql_col = on_loan_sort_cols[sort_by]
-            if sort_by == 'student_name_loan': on_loan_order_by = f"ORDER BY s.surname {sort_dir.upper()}, s.name {sort_dir.upper()}"
-            elif sort_by == 'device_id_loan': on_loan_order_by = f"ORDER BY d.rubric_id {sort_dir.upper()}, d.suffix_id {sort_dir.upper()}"
-            else: on_loan_order_by = f"ORDER BY {sql_col} {sort_dir.upper()}"
-        elif sort_by in history_sort_cols:
-            sql_col = history_sort_cols[sort_by]
-            if sort_by == 'student_name_history': history_order_by = f"ORDER BY s.surname {sort_dir.upper()}, s.name {sort_dir.upper()}"
-            elif sort_by == 'device_id_history': history_order_by = f"ORDER BY d.rubric_id {sort_dir.upper()}, d.suffix_id {sort_dir.upper()}"
-            else: history_order_by = f"ORDER BY {sql_col} {sort_dir.upper()}"
-
-        c.execute(f"SELECT * FROM devices {inventory_order_by}")
-        devices_raw = c.fetchall()
-        
-        c.execute(f"SELECT s.name, s.surname, d.rubric_id, d.suffix_id, l.loan_time, l.return_time FROM loans l JOIN students s ON l.student_id = s.id JOIN devices d ON l.device_id = d.id {history_order_by}")
-        loan_records = c.fetchall()
-        
-        c.execute(f"SELECT d.rubric_id, d.suffix_id, d.category, s.name, s.surname, s.email, d.id FROM devices d JOIN loans l ON d.id = l.device_id JOIN students s ON l.student_id = s.id WHERE d.available = 0 AND l.return_time IS NULL {on_loan_order_by}")
-        devices_on_loan_list = c.fetchall()
-        
-        formatted_loans = [{'student_name': f"{r[0]} {r[1]}", 'device_id': f"{r[2]}-{r[3]}", 'loan_date': format_dt(r[4])[0], 'loan_time': format_dt(r[4])[1], 'return_date': format_dt(r[5])[0], 'return_time': format_dt(r[5])[1], 'status': "Returned" if r[5] else "On Loan"} for r in loan_records]
-        
-        # Modified to include Database ID for linking
-        devices_on_loan_formatted = [[f"{r[0]}-{r[1]}", r[2], r[3], r[4], r[5], r[6]] for r in devices_on_loan_list]
-        
-        conn.close()
-        return render_template("admin.html", devices=devices_raw, loans=formatted_loans, devices_on_loan=devices_on_loan_formatted, sort_by=sort_by, sort_dir=sort_dir)
+        # Only the first page of each table is rendered; the rest is fetched from admin_table_api
+        pages = {}
+        for table in ADMIN_TABLES:
+            rows, next_cursor, table_sort_by, table_sort_dir = fetch_admin_page(c, table, sort_by, sort_dir)
+            pages[table] = {'rows': rows, 'next_cursor': next_cursor, 'sort_by': table_sort_by, 'sort_dir': table_sort_dir}
+
+        return render_template("admin.html", devices=pages['inventory'], loans=pages['history'], devices_on_loan=pages['on_loan'], sort_by=sort_by, sort_dir=sort_dir, rubric_prefixes=RUBRIC_PREFIXES)
+
+# --- Bulk Device Onboarding ---
+# A delivery of devices is uploaded as one CSV/XLSX file. Rows are validated as they are
+# read, written to a temp staging table with executemany, and upserted into devices with a
+# single INSERT ... ON CONFLICT in one transaction; the response reports every row.
+
+# Also drives the automatic prefix in the Add New Device form (see admin.js)
+RUBRIC_PREFIXES = {
+    'Laptop': 'SHC-LQ-',
+    'Charger': 'SHC-LP-',
+    'iPad': 'SHC-IQ-',
+    'Headphones': 'SHC-HP-',
+    'Trips': 'SHC-TRIPS-',
+    'iPad Charger': 'SHC-IPC-',
+    'USBC Charger': 'SHC-UBC-',
+    'Other': 'SHC-'
+}
+BULK_IMPORT_MAX_ROWS = 5000
+
+def iter_device_sheet(file):
+    # Yields (row number, {column: value}) with headers normalised to lower_snake_case
+    name = (file.filename or "").lower()
+    if name.endswith(".xlsx"):
+        wb = load_workbook(file.stream, read_only=True, data_only=True)
+        try:
+            rows = wb.active.iter_rows(values_only=True)
+            header = next(rows, None) or ()
+            keys = [str(h or "").strip().lower().replace(" ", "_") for h in header]
+            for number, values in enumerate(rows, start=2):
+                yield number, dict(zip(keys, values))
+        finally:
+            wb.close()
+    elif name.endswith(".csv"):
+        text = io.TextIOWrapper(file.stream, encoding="utf-8-sig", newline="")
+        reader = csv.reader(text)
+        keys = [h.strip().lower().replace(" ", "_") for h in next(reader, [])]
+        for number, values in enumerate(reader, start=2):
+            yield number, dict(zip(keys, values))
+    else:
+        raise ValueError("Please upload a .csv or .xlsx file.")
+
+def _cell_text(value):
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)  # Excel hands whole-number suffixes back as floats
+    return str(value).strip()
+
+def validate_device_rows(rows, report):
+    # Generator fed straight into executemany; invalid rows only go into the report
+    seen = {}
+    for number, row in rows:
+        if number - 1 > BULK_IMPORT_MAX_ROWS:
+            raise ValueError(f"Too many rows; the limit is {BULK_IMPORT_MAX_ROWS} devices per file.")
+        category, suffix_id = _cell_text(row.get("category")), _cell_text(row.get("suffix_id"))
+        rubric_id, notes = _cell_text(row.get("rubric_id")), _cell_text(row.get("notes")) or None
+        if not any((category, suffix_id, rubric_id, notes)):
+            continue  # blank line
+        if not rubric_id:
+            rubric_id = RUBRIC_PREFIXES.get(category, "")
+        full_id = f"{rubric_id}-{suffix_id}"
+        if not category:
+            error = "Missing category."
+        elif not suffix_id:
+            error = "Missing suffix_id."
+        elif not rubric_id:
+            error = f"Unknown category '{category}'; add a rubric_id column for it."
+        elif (rubric_id, suffix_id) in seen:
+            error = f"Duplicate of row {seen[(rubric_id, suffix_id)]}."
+        else:
+            error = None
+        if error:
+            report.append({'row': number, 'device_id': full_id, 'status': 'invalid', 'message': error})
+            continue
+        seen[(rubric_id, suffix_id)] = number
+        report.append({'row': number, 'device_id': full_id, 'status': None, 'message': ''})
+        yield number, rubric_id, suffix_id, category, notes
+
+def bulk_upsert_devices(conn, file):
+    report = []
+    c = conn.cursor()
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS staged_devices (row_num INTEGER PRIMARY KEY, rubric_id TEXT, suffix_id TEXT, category TEXT, notes TEXT)")
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("DELETE FROM temp.staged_devices")
+        c.executemany("INSERT INTO temp.staged_devices VALUES (?, ?, ?, ?, ?)", validate_device_rows(iter_device_sheet(file), report))
+        c.execute("SELECT s.row_num FROM temp.staged_devices s JOIN devices d ON d.rubric_id = s.rubric_id AND d.suffix_id = s.suffix_id")
+        existing = {r[0] for r in c.fetchall()}
+        c.execute("""INSERT INTO devices (rubric_id, suffix_id, category, available, notes)
+                     SELECT rubric_id, suffix_id, category, 1, notes FROM temp.staged_devices WHERE true ORDER BY row_num
+                     ON CONFLICT(rubric_id, suffix_id) DO UPDATE SET category = excluded.category, notes = COALESCE(excluded.notes, devices.notes)""")
+        c.execute("""SELECT s.row_num, d.id, d.rubric_id, d.suffix_id, d.category FROM temp.staged_devices s
+                     JOIN devices d ON d.rubric_id = s.rubric_id AND d.suffix_id = s.suffix_id""")
+        stored = {r[0]: r[1:] for r in c.fetchall()}
+        c.execute("DELETE FROM temp.staged_devices")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    created, updated = [], []
+    for entry in report:
+        if entry['status'] is None:
+            device = stored[entry['row']]
+            is_update = entry['row'] in existing
+            entry['status'] = 'updated' if is_update else 'created'
+            entry['id'] = device[0]
+            (updated if is_update else created).append(device)
+    summary = {'created': len(created), 'updated': len(updated),
+               'invalid': sum(1 for e in report if e['status'] == 'invalid'), 'rows': report}
+    return summary, created, updated
+
+@app.route("/admin/devices/import", methods=["POST"])
+@login_required
+def import_devices():
+    wants_json = request.accept_mimetypes.best == 'application/json'
+    file = request.files.get('device_file')
+    try:
+        if not file or not file.filename:
+            raise ValueError("No file selected for import.")
+        summary, created, updated = bulk_upsert_devices(get_db_connection(), file)
+    except (ValueError, KeyError, UnicodeDecodeError, zipfile.BadZipFile, sqlite3.Error) as e:
+        if wants_json:
+            return jsonify({'error': f"Could not import devices: {e}"}), 400
+        flash(f"Could not import devices: {e}", "error")
+        return redirect(url_for("admin"))
+
+    if created:
+        publish_change('device_added', devices=[feed_device(d) for d in created])
+    if updated:
+        publish_change('device_updated', devices=[{'id': d[0]} for d in updated])
+    if wants_json:
+        return jsonify(summary)
+    flash(f"Bulk import: {summary['created']} added, {summary['updated']} updated, {summary['invalid']} rows skipped.",
+          "success" if not summary['invalid'] else "error")
+    return redirect(url_for("admin"))
+
+@app.route("/admin/api/<table>")
+@login_required
+def admin_table_api(table):
+    if table not in ADMIN_TABLES:
+        abort(404)
+    try:
+        limit = min(max(int(request.args.get('limit', ADMIN_PAGE_SIZE)), 1), 500)
+        rows, next_cursor, sort_by, sort_dir = fetch_admin_page(get_db_connection().cursor(), table,
+                                                                request.args.get('sort_by'), request.args.get('sort_dir'),
+                                                                request.args.get('cursor'), limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    html = render_template("_admin_rows.html", table=table, rows=rows)
+    return jsonify({'rows': rows, 'html': html, 'next_cursor': next_cursor, 'sort_by': sort_by, 'sort_dir': sort_dir})
+
+@app.route("/admin/search")
+@login_required
+def admin_search():
+    text = request.args.get('q', '').strip()
+    section = request.args.get('section')
+    if section and section not in SEARCHERS:
+        return jsonify({'error': f"Unknown search section '{section}'."}), 400
+    c = get_db_connection().cursor()
+    results = {'query': text}
+    try:
+        # One section when paging with a cursor, otherwise the first page of each
+        for name in [section] if section else SEARCH_SECTIONS:
+            rows, next_cursor = SEARCHERS[name](c, text, request.args.get('cursor') if section else None)
+            html = render_template("_search_rows.html", section=name, rows=rows)
+            results[name] = {'rows': rows, 'html': html, 'next_cursor': next_cursor}
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(results)
 
 @app.route("/admin/device/<int:device_id>", methods=["GET", "POST"])
 @login_required
@@ -351,16 +1821,17 @@ def device_detail(device_id):
         try:
             c.execute("UPDATE devices SET notes = ? WHERE id = ?", (new_note, device_id))
             conn.commit()
+            publish_change('device_updated', devices=[{'id': device_id, 'has_notes': bool(new_note)}])
             flash("Device notes updated successfully.", "success")
         except sqlite3.Error as e:
             flash(f"Error updating notes: {e}", "error")
+            conn.rollback()
 
     # Get main device info
     c.execute("SELECT * FROM devices WHERE id = ?", (device_id,))
     device = c.fetchone()
 
     if not device:
-        conn.close()
         flash("Device not found.", "error")
         return redirect(url_for('admin'))
 
@@ -385,49 +1856,495 @@ def device_detail(device_id):
             'returned_at': f"{ret_d} {ret_t}" if row[4] else "STILL ON LOAN"
         })
 
-    conn.close()
     return render_template("device_detail.html", device=device, history=history)
 
+@app.route("/admin/stats")
+@login_required
+def admin_stats():
+    try:
+        weeks = min(max(int(request.args.get('weeks', STATS_DEFAULT_WEEKS)), 1), 520)
+    except ValueError:
+        weeks = STATS_DEFAULT_WEEKS
+    stats = load_utilisation_stats(get_db_connection().cursor(), weeks)
+    if request.args.get('format') == 'json':
+        return jsonify(stats)
+    return render_template("stats.html", stats=stats)
+
+@app.route("/admin/sites")
+@login_required
+def admin_sites():
+    try:
+        weeks = min(max(int(request.args.get('weeks', STATS_DEFAULT_WEEKS)), 1), 520)
+    except ValueError:
+        weeks = STATS_DEFAULT_WEEKS
+    report = load_cross_site_report(weeks)
+    if request.args.get('format') == 'json':
+        return jsonify(report)
+    for row in report['sites']:
+        row['admin_url'] = site_url(row['site'], 'admin')
+    return render_template("sites.html", report=report)
+
+@app.route("/metrics")
+def metrics():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        abort(401)
+    lines = []
+    for histogram in (REQUEST_SECONDS, QUERY_SECONDS, TEMPLATE_SECONDS):
+        lines.extend(histogram.render())
+    lines += ["# HELP devicelogger_slow_queries_total Statements slower than the slow-query threshold.",
+              "# TYPE devicelogger_slow_queries_total counter",
+              f"devicelogger_slow_queries_total {_slow_query_count}",
+              "# HELP devicelogger_db_pool_idle_connections Idle pooled SQLite connections.",
+              "# TYPE devicelogger_db_pool_idle_connections gauge"]
+    with _db_pools_lock:
+        pools = list(_db_pools.items())
+    lines += [f'devicelogger_db_pool_idle_connections{{db="{_metric_label(db)}"}} {pool.qsize()}' for db, pool in pools]
+    lines += ["# HELP devicelogger_feed_subscribers Open /events streams.",
+              "# TYPE devicelogger_feed_subscribers gauge"]
+    with _cache_lock:
+        feeds = list(_change_feeds.items())
+    lines += [f'devicelogger_feed_subscribers{{db="{_metric_label(db)}"}} {feed.subscriber_count()}' for db, feed in feeds]
+    response = make_response("\n".join(lines) + "\n")
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+@app.route("/events")
+def change_events():
+    feed = get_change_feed()
+    q = feed.subscribe()
+    if q is None:
+        response = jsonify({'error': "Too many live connections, please retry shortly."})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(FEED_HEARTBEAT_SECONDS)
+        return response
+    last_seen = request.headers.get('Last-Event-ID')
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            # A reconnecting client missed whatever was published while it was away
+            if last_seen and last_seen != str(feed.last_id):
+                yield f"id: {feed.last_id}\nevent: resync\ndata: {{}}\n\n"
+            while True:
+                try:
+                    event = q.get(timeout=FEED_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"  # also how a dropped connection gets noticed
+                    continue
+                yield f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+        finally:
+            feed.unsubscribe(q)
+
+    response = app.response_class(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route("/scan", methods=["GET", "POST"])
+@login_required
+def scan_station():
+    if request.method == "GET":
+        return render_template("scan.html")
+
+    scan = request.get_json(silent=True)
+    if not isinstance(scan, dict):
+        return jsonify({'device_id': '', 'action': None, 'status': 'error', 'message': "Malformed scan."}), 400
+    # Scanners send whatever they read, so every field is coerced to a string up front
+    full_id, name, surname, email = ('' if scan.get(k) is None else str(scan.get(k)).strip()
+                                     for k in ('device_id', 'name', 'surname', 'email'))
+    action = str(scan.get('action', 'return'))
+    ack = {'device_id': full_id, 'action': action}
+    if action not in ('return', 'checkout'):
+        return jsonify({**ack, 'status': 'error', 'message': "Unknown scan action."}), 400
+    if action == 'checkout' and not is_valid_student_email(email):
+        return jsonify({**ack, 'status': 'error', 'message': "Invalid email address. Please use a valid GDST email."}), 400
+    if action == 'checkout' and not (name and surname):
+        return jsonify({**ack, 'status': 'error', 'message': "Please enter the student's name and surname."}), 400
+
+    device_pk = lookup_device_id(full_id)
+    if not device_pk:
+        return jsonify({**ack, 'status': 'unknown_device', 'message': f"No device with ID {full_id}."})
+
+    future = get_scan_batcher().submit({'action': action, 'device_pk': device_pk, 'name': name,
+                                        'surname': surname, 'email': email})
+    try:
+        status, message = future.result(timeout=SCAN_ACK_TIMEOUT_SECONDS)
+    except FutureTimeoutError:
+        return jsonify({**ack, 'status': 'error', 'message': "Timed out waiting for the database."}), 504
+    except sqlite3.Error as e:
+        return jsonify({**ack, 'status': 'error', 'message': f"Database Error: {e}"}), 500
+    return jsonify({**ack, 'status': status, 'message': message})
+
+# --- Admin Data Export ---
+# Exports never hold a full result set in memory: rows are pulled from SQLite in chunks,
+# dates/status are formatted by SQLite itself, and the writers only keep the current chunk.
+
+EXPORT_CHUNK_ROWS = 1000
+
+def _sql_export_date(col):
+    # Same output as format_dt()[0]; SQLite's strftime has no %y, so trim the year by hand
+    return (f"CASE WHEN {col} IS NULL OR {col} = '' THEN 'N/A' "
+            f"ELSE IFNULL(strftime('%d/%m/', {col}) || substr(strftime('%Y', {col}), 3, 2), 'Invalid Date') END")
+
+def _sql_export_time(col):
+    return f"CASE WHEN {col} IS NULL OR {col} = '' THEN 'N/A' ELSE IFNULL(strftime('%H:%M', {col}), 'Invalid Time') END"
+
+EXPORT_SHEETS = [
+    ('Devices On Loan', "SELECT d.rubric_id || '-' || d.suffix_id AS 'Device ID', d.category AS 'Category', s.name || ' ' || s.surname AS 'Student Name', s.email AS 'Student Email' FROM devices d JOIN loans l ON d.id = l.device_id JOIN students s ON l.student_id = s.id WHERE d.available = 0 AND l.return_time IS NULL ORDER BY d.category, s.surname"),
+    ('Current Inventory', "SELECT id AS 'Database ID', rubric_id AS 'Rubric ID', suffix_id AS 'Suffix ID', category AS 'Category', CASE WHEN available = 1 THEN 'Loanable' ELSE 'Loaned Out' END AS 'Status', notes AS 'Notes' FROM devices ORDER BY id DESC"),
+    ('Loan History', f"SELECT s.name || ' ' || s.surname AS 'Student Name', d.rubric_id || '-' || d.suffix_id AS 'Device ID', d.category AS 'category', "
+                     f"{_sql_export_date('l.loan_time')} AS 'Loan Date', {_sql_export_time('l.loan_time')} AS 'Loan Time', "
+                     f"{_sql_export_date('l.return_time')} AS 'Return Date', {_sql_export_time('l.return_time')} AS 'Return Time', "
+                     f"CASE WHEN l.return_time IS NULL OR l.return_time = '' THEN 'On Loan' ELSE 'Returned' END AS 'Status' "
+                     f"FROM loans l JOIN students s ON l.student_id = s.id JOIN devices d ON l.device_id = d.id ORDER BY l.loan_time DESC"),
+]
+
+def iter_export_chunks(conn, sql):
+    # Yields the header row on its own, then lists of at most EXPORT_CHUNK_ROWS rows
+    c = conn.cursor()
+    c.execute(sql)
+    yield [[col[0] for col in c.description]]
+    while True:
+        rows = c.fetchmany(EXPORT_CHUNK_ROWS)
+        if not rows:
+            break
+        yield rows
+
+class _ChunkBuffer:
+    # Write-only sink so zipfile can be drained into the response as it is produced
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def write_export_workbook(conn, target):
+    # write_only workbooks spool each sheet to disk row by row instead of building cells in memory
+    wb = Workbook(write_only=True)
+    for sheet_name, sql in EXPORT_SHEETS:
+        ws = wb.create_sheet(sheet_name)
+        for rows in iter_export_chunks(conn, sql):
+            for row in rows:
+                ws.append(row)
+    wb.save(target)
+
+def stream_export_zip(db_file):
+    buf = _ChunkBuffer()
+    with pooled_connection(db_file) as conn:
+        conn.execute("BEGIN")  # one read snapshot, so all three files agree with each other
+        try:
+            with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+                for sheet_name, sql in EXPORT_SHEETS:
+                    with zf.open(f"{sheet_name}.csv", "w", force_zip64=True) as raw:
+                        text = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+                        writer = csv.writer(text)
+                        for rows in iter_export_chunks(conn, sql):
+                            writer.writerows(rows)
+                            text.flush()
+                            yield buf.drain()
+                        text.detach()
+            yield buf.drain()
+        finally:
+            conn.rollback()
+
 @app.route("/export_admin_data")
 @login_required
 def export_admin_data():
+    date_stamp = datetime.now().strftime('%d%m%Y')
+    if current_site():
+        date_stamp = f"{current_site()}_{date_stamp}"
+    if request.args.get('format') == 'csv':
+        response = app.response_class(stream_export_zip(current_db_file()), mimetype='application/zip')
+        response.headers['Content-Disposition'] = f'attachment; filename="DeviceLoanReport_{date_stamp}.zip"'
+        return response
+
     conn = get_db_connection()
-    output = io.BytesIO()
+    # Spooled to an anonymous temp file (deleted once sent) rather than an in-memory BytesIO
+    output = tempfile.TemporaryFile()
     try:
-        df_on_loan = pd.read_sql_query("SELECT d.rubric_id || '-' || d.suffix_id AS 'Device ID', d.category AS 'Category', s.name || ' ' || s.surname AS 'Student Name', s.email AS 'Student Email' FROM devices d JOIN loans l ON d.id = l.device_id JOIN students s ON l.student_id = s.id WHERE d.available = 0 AND l.return_time IS NULL ORDER BY d.category, s.surname", conn)
-        df_inventory = pd.read_sql_query("SELECT id AS 'Database ID', rubric_id AS 'Rubric ID', suffix_id AS 'Suffix ID', category AS 'Category', CASE WHEN available = 1 THEN 'Loanable' ELSE 'Loaned Out' END AS 'Status', notes AS 'Notes' FROM devices ORDER BY id DESC", conn)
-        df_history = pd.read_sql_query("SELECT s.name || ' ' || s.surname AS 'Student Name', d.rubric_id || '-' || d.suffix_id AS 'Device ID', d.category, l.loan_time, l.return_time FROM loans l JOIN students s ON l.student_id = s.id JOIN devices d ON l.device_id = d.id ORDER BY l.loan_time DESC", conn)
-
-        df_history[['Loan Date', 'Loan Time']] = df_history['loan_time'].apply(lambda x: pd.Series(format_dt(x)))
-        df_history[['Return Date', 'Return Time']] = df_history['return_time'].apply(lambda x: pd.Series(format_dt(x)))
-        df_history['Status'] = df_history['return_time'].apply(lambda x: 'Returned' if x else 'On Loan')
-        df_history.drop(columns=['loan_time', 'return_time'], inplace=True)
-
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df_on_loan.to_excel(writer, sheet_name='Devices On Loan', index=False)
-            df_inventory.to_excel(writer, sheet_name='Current Inventory', index=False)
-            df_history.to_excel(writer, sheet_name='Loan History', index=False)
-        
+        conn.execute("BEGIN")
+        try:
+            write_export_workbook(conn, output)
+        finally:
+            conn.rollback()
         output.seek(0)
-        filename = f"DeviceLoanReport_{datetime.now().strftime('%d%m%Y')}.xlsx"
+        filename = f"DeviceLoanReport_{date_stamp}.xlsx"
         return send_file(output, as_attachment=True, download_name=filename, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
 
     except Exception as e:
+        output.close()
         flash(f"Error exporting Excel file: {e}", "error")
         return redirect(url_for("admin"))
+
+# --- Database Snapshots ---
+# Downloads and scheduled backups are made with VACUUM INTO, which copies a consistent
+# read snapshot (including anything still sitting in the WAL) into a compacted, single
+# file without blocking writers. The latest snapshot is cached and only rebuilt once the
+# database files have actually changed, so repeated downloads don't touch the live DB.
+
+SNAPSHOT_DIR = "backups"
+SNAPSHOT_INTERVAL_HOURS = 24   # scheduled snapshots; 0 disables the scheduler
+SNAPSHOT_KEEP = 14             # scheduled snapshots retained per database
+
+_snapshot_lock = threading.Lock()
+
+def _db_signature(db_file):
+    # Any commit touches the -wal file (or the main file once checkpointed)
+    parts = []
+    for path in (db_file, db_file + "-wal"):
+        try:
+            st = os.stat(path)
+            parts.append(f"{st.st_mtime_ns}:{st.st_size}")
+        except FileNotFoundError:
+            parts.append("-")
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()[:16]
+
+def write_snapshot(db_file, dest):
+    tmp = f"{dest}.{os.getpid()}.tmp"  # worker processes may build the same snapshot at once
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    with pooled_connection(db_file) as conn:
+        conn.execute("VACUUM INTO ?", (tmp,))
+    # Snapshots get downloaded and shared between sites, so leave out the session secret,
+    # admin login and change log (secure_delete overwrites the freed pages)
+    snapshot = sqlite3.connect(tmp)
+    try:
+        snapshot.execute("PRAGMA secure_delete = ON")
+        snapshot.execute("DELETE FROM settings")
+        snapshot.execute("DELETE FROM change_events")
+        snapshot.commit()
     finally:
-        conn.close()
+        snapshot.close()
+    os.replace(tmp, dest)  # readers never see a half-written snapshot
+    return dest
+
+def _gzip_file(src, dest):
+    tmp = dest + ".tmp"
+    with open(src, "rb") as f_in, gzip.open(tmp, "wb", compresslevel=6) as f_out:
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+    os.replace(tmp, dest)
+    return dest
+
+def get_cached_snapshot(db_file, compress=False):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    name = os.path.splitext(os.path.basename(db_file))[0]
+    with _snapshot_lock:
+        signature = _db_signature(db_file)
+        path = os.path.join(SNAPSHOT_DIR, f"{name}-latest-{signature}.db")
+        if not os.path.exists(path):
+            for old in os.listdir(SNAPSHOT_DIR):
+                if old.startswith(f"{name}-latest-"):
+                    os.remove(os.path.join(SNAPSHOT_DIR, old))
+            write_snapshot(db_file, path)
+        if compress:
+            gz_path = path + ".gz"
+            if not os.path.exists(gz_path):
+                _gzip_file(path, gz_path)
+            return os.path.abspath(gz_path)
+        return os.path.abspath(path)
+
+def take_scheduled_snapshot(db_file, keep=SNAPSHOT_KEEP):
+    folder = os.path.join(SNAPSHOT_DIR, "scheduled")
+    os.makedirs(folder, exist_ok=True)
+    name = os.path.splitext(os.path.basename(db_file))[0]
+    write_snapshot(db_file, os.path.join(folder, f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"))
+    # Timestamped names sort chronologically, so everything before the last `keep` goes
+    snapshots = sorted(f for f in os.listdir(folder) if f.startswith(f"{name}_") and f.endswith(".db"))
+    for old in snapshots[:-keep] if keep > 0 else []:
+        os.remove(os.path.join(folder, old))
+
+def start_snapshot_scheduler(db_file=None, interval_hours=SNAPSHOT_INTERVAL_HOURS, keep=SNAPSHOT_KEEP):
+    if interval_hours <= 0:
+        return None
+    db_file = db_file or current_db_file()
+
+    def run():
+        last_signature = None
+        while True:
+            try:
+                signature = _db_signature(db_file)
+                if signature != last_signature:  # nothing changed, nothing worth keeping twice
+                    take_scheduled_snapshot(db_file, keep)
+                    last_signature = signature
+            except (OSError, sqlite3.Error) as e:
+                print(f"Scheduled snapshot failed: {e}", file=sys.stderr)
+            time.sleep(interval_hours * 3600)
+
+    thread = threading.Thread(target=run, name="snapshot-scheduler", daemon=True)
+    thread.start()
+    return thread
 
 @app.route("/export_db")
 @login_required
 def export_db():
     try:
-        filename = f"DeviceLoanBackup_{datetime.now().strftime('%d%m%Y')}.db"
-        return send_file(DB_FILE, as_attachment=True, download_name=filename, mimetype='application/x-sqlite3')
+        compress = request.args.get('compress') == 'gzip'
+        path = get_cached_snapshot(current_db_file(), compress=compress)
+        filename = f"DeviceLoanBackup_{current_site() + '_' if current_site() else ''}{datetime.now().strftime('%d%m%Y')}.db"
+        if compress:
+            return send_file(path, as_attachment=True, download_name=filename + ".gz", mimetype='application/gzip')
+        return send_file(path, as_attachment=True, download_name=filename, mimetype='application/x-sqlite3')
     except Exception as e:
         flash(f"Error exporting database file: {e}", "error")
         return redirect(url_for("admin"))
 
+# --- Database Import ---
+# Uploads are never written over the live file. They are streamed to a staging file next
+# to it, checked (SQLite header, integrity_check, schema version and required columns) and
+# migrated to the current schema. Only then are they applied through SQLite itself: either
+# copied over the live database with the online backup API ("replace"), or ATTACHed and
+# upserted on natural keys in one transaction ("merge"). Open connections stay valid
+# either way, and a bad file leaves the live database untouched.
+
+IMPORT_REQUIRED_COLUMNS = {
+    'devices': {'id', 'rubric_id', 'suffix_id', 'category', 'available'},
+    'students': {'id', 'name', 'surname', 'email'},
+    'loans': {'id', 'student_id', 'device_id', 'loan_time', 'return_time'},
+}
+
+def stage_upload(file, db_file):
+    fd, staged_path = tempfile.mkstemp(prefix="import-", suffix=".db", dir=os.path.dirname(os.path.abspath(db_file)))
+    os.close(fd)
+    file.save(staged_path)  # copies the upload stream in chunks
+    return staged_path
+
+def discard_staged(staged_path):
+    for path in (staged_path, staged_path + "-wal", staged_path + "-shm", staged_path + "-journal"):
+        if os.path.exists(path):
+            os.remove(path)
+
+def validate_staged_db(staged_path):
+    with open(staged_path, "rb") as f:
+        if f.read(16) != b"SQLite format 3\x00":
+            raise ValueError("The uploaded file is not a SQLite database.")
+
+    conn = sqlite3.connect(staged_path)
+    try:
+        result = conn.execute("PRAGMA integrity_check").fetchall()
+        if result != [("ok",)]:
+            raise ValueError(f"The uploaded database failed its integrity check ({result[0][0]}).")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise ValueError(f"The uploaded database is from a newer version of this app (schema {version}).")
+        for table, required in IMPORT_REQUIRED_COLUMNS.items():
+            columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            missing = required - columns
+            if missing:
+                raise ValueError(f"The uploaded database is missing {table} columns: {', '.join(sorted(missing))}.")
+        run_migrations(conn)
+        conn.execute("PRAGMA journal_mode = DELETE")  # fold any WAL into the file before it is copied
+    except sqlite3.DatabaseError as e:
+        raise ValueError(f"The uploaded database could not be read: {e}.")
+    finally:
+        conn.close()
+
+def restore_from_staged(staged_path, db_file):
+    staged = sqlite3.connect(staged_path)
+    try:
+        with pooled_connection(db_file) as live:
+            # A WAL database can't change page size, so match the live one before copying
+            live_page_size = live.execute("PRAGMA page_size").fetchone()[0]
+            if staged.execute("PRAGMA page_size").fetchone()[0] != live_page_size:
+                staged.execute(f"PRAGMA page_size = {live_page_size}")
+                staged.execute("VACUUM")
+            # The upload brings its own copies of these; keep this server's secret and login, and
+            # keep change ids moving forward so other workers' relays see new changes. They are
+            # written into the staged file first, so the backup below is the only step that
+            # touches the live database and nothing can fail half-way through the restore.
+            settings = live.execute("SELECT key, value FROM settings").fetchall()
+            last_change = live.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'change_events'").fetchone()[0]
+            staged.execute("BEGIN")
+            staged.execute("DELETE FROM settings")
+            staged.executemany("INSERT INTO settings (key, value) VALUES (?, ?)", settings)
+            staged.execute("DELETE FROM change_events")
+            staged.execute("DELETE FROM sqlite_sequence WHERE name = 'change_events' AND seq < ?", (last_change,))
+            staged.execute("""INSERT INTO sqlite_sequence (name, seq) SELECT 'change_events', ?
+                              WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'change_events')""", (last_change,))
+            staged.commit()
+            staged.backup(live)
+    finally:
+        staged.close()
+
+def merge_from_staged(staged_path, db_file):
+    # Devices match on rubric_id + suffix_id, students on email and loans on device + loan_time.
+    # Local values win; the upload only fills gaps (missing notes/names, loans we don't have,
+    # and returns recorded at the other site for loans still open here).
+    with pooled_connection(db_file) as conn:
+        c = conn.cursor()
+        c.execute("ATTACH DATABASE ? AS src", (staged_path,))
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            # rowcount, not total_changes: the search-index triggers' writes don't count
+            c.execute("""INSERT INTO main.devices (rubric_id, suffix_id, category, available, notes)
+                         SELECT rubric_id, suffix_id, category, 1, notes FROM src.devices WHERE true
+                         ON CONFLICT(rubric_id, suffix_id) DO UPDATE SET notes = COALESCE(devices.notes, excluded.notes)
+                         WHERE devices.notes IS NULL AND excluded.notes IS NOT NULL""")
+            devices = c.rowcount
+
+            c.execute("""INSERT INTO main.students (name, surname, email)
+                         SELECT name, surname, email FROM src.students WHERE email IS NOT NULL
+                         ON CONFLICT(email) DO UPDATE SET name = COALESCE(students.name, excluded.name),
+                                                          surname = COALESCE(students.surname, excluded.surname)
+                         WHERE students.name IS NULL OR students.surname IS NULL""")
+            students = c.rowcount
+
+            c.execute("""CREATE TEMP TABLE merge_loans AS
+                         SELECT ms.id AS student_id, md.id AS device_id, sl.loan_time, sl.return_time
+                         FROM src.loans sl
+                         JOIN src.students ss ON sl.student_id = ss.id
+                         JOIN src.devices sd ON sl.device_id = sd.id
+                         JOIN main.students ms ON ms.email = ss.email
+                         JOIN main.devices md ON md.rubric_id = sd.rubric_id AND md.suffix_id = sd.suffix_id""")
+            c.execute("CREATE INDEX temp.idx_merge_loans_device ON merge_loans(device_id, loan_time)")
+            # A device can only be out on one loan. Where both sites have it open, the older
+            # loan is closed at the newer one's loan time (on whichever side it came from).
+            c.execute("""UPDATE temp.merge_loans SET return_time = (
+                             SELECT MIN(l.loan_time) FROM main.loans l WHERE l.device_id = merge_loans.device_id
+                               AND l.return_time IS NULL AND l.loan_time > merge_loans.loan_time)
+                         WHERE return_time IS NULL AND EXISTS (
+                             SELECT 1 FROM main.loans l WHERE l.device_id = merge_loans.device_id
+                               AND l.return_time IS NULL AND l.loan_time > merge_loans.loan_time)""")
+            c.execute("""UPDATE main.loans SET return_time = (
+                             SELECT MIN(m.loan_time) FROM temp.merge_loans m WHERE m.device_id = loans.device_id
+                               AND m.return_time IS NULL AND m.loan_time > loans.loan_time)
+                         WHERE return_time IS NULL AND EXISTS (
+                             SELECT 1 FROM temp.merge_loans m WHERE m.device_id = loans.device_id
+                               AND m.return_time IS NULL AND m.loan_time > loans.loan_time)""")
+            c.execute("""INSERT INTO main.loans (student_id, device_id, loan_time, return_time)
+                         SELECT student_id, device_id, loan_time, return_time FROM temp.merge_loans m
+                         WHERE NOT EXISTS (SELECT 1 FROM main.loans l WHERE l.device_id = m.device_id AND l.loan_time = m.loan_time)""")
+            loans = c.rowcount
+            backfill_due_times(c)  # merged loans are due by this site's loan periods
+            c.execute("""UPDATE main.loans SET return_time = m.return_time FROM temp.merge_loans m
+                         WHERE loans.return_time IS NULL AND m.return_time IS NOT NULL
+                           AND loans.device_id = m.device_id AND loans.loan_time = m.loan_time""")
+            c.execute("DROP TABLE temp.merge_loans")
+            rebuild_stats(c)
+
+            # Availability follows from the merged loans rather than from either file's flag
+            c.execute("""UPDATE main.devices SET available = new.available FROM (
+                             SELECT d.id, CASE WHEN EXISTS (SELECT 1 FROM main.loans l WHERE l.device_id = d.id AND l.return_time IS NULL)
+                                               THEN 0 ELSE 1 END AS available
+                             FROM main.devices d) new
+                         WHERE devices.id = new.id AND devices.available IS NOT new.available""")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            c.execute("DETACH DATABASE src")
+    return {'devices': devices, 'students': students, 'loans': loans}
+
 @app.route("/import_admin_data", methods=["POST"])
 @login_required
 def import_admin_data():
@@ -439,18 +2356,154 @@ def import_admin_data():
     if not file.filename.endswith('.db'):
         flash("Invalid file type. Please upload a .db file.", "error")
         return redirect(url_for("admin"))
-    
+
+    mode = request.form.get('import_mode', 'replace')
+    if mode not in ('replace', 'merge'):
+        flash(f"Unknown import mode '{mode}'. The database was not changed.", "error")
+        return redirect(url_for("admin"))
+    staged_path = None
     try:
-        file.save(DB_FILE)
-        flash("Database successfully imported. All previous data has been replaced.", "success")
+        staged_path = stage_upload(file, current_db_file())
+        validate_staged_db(staged_path)
+        if mode == 'merge':
+            counts = merge_from_staged(staged_path, current_db_file())
+            publish_change('reload', reason='import')
+            flash(f"Database merged: {counts['devices']} devices, {counts['students']} students and {counts['loans']} loans added or updated.", "success")
+        else:
+            restore_from_staged(staged_path, current_db_file())
+            publish_change('reload', reason='import')
+            flash("Database successfully imported. All previous data has been replaced.", "success")
+    except ValueError as e:
+        flash(f"Import rejected: {e} The database was not changed.", "error")
     except Exception as e:
-        flash(f"Error saving database file: {e}. The database was not changed.", "error")
+        flash(f"Error importing database file: {e}. The database was not changed.", "error")
+    finally:
+        if staged_path:
+            discard_staged(staged_path)
     
     return redirect(url_for("admin"))
 
+# --- Production Serving ---
+# `flask --app app serve --workers 4` pre-forks worker processes that share one listening
+# socket (the kernel hands each connection to whichever worker accepts first), and each
+# worker serves requests on threads. Migrations and first-run setup happen once, in the
+# parent and under a file lock, before anything is forked; the parent then only restarts
+# workers that die. Worker 0 also runs the snapshot and overdue-reminder schedulers
+# (one of each per site).
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock (and no fork, so serve runs a single process)
+    fcntl = None
+
+@contextmanager
+def startup_lock(db_file=None):
+    with open((db_file or DB_FILE) + ".lock", "a") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+def prepare_app(new_credentials=False):
+    """Migrate every site's database and load the shared session secret, creating credentials if needed."""
+    with startup_lock():
+        for db_file in all_db_files():
+            init_db(db_file)
+        conn = sqlite3.connect(DB_FILE)
+        try:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            if new_credentials or get_setting(c, 'secret_key') is None:
+                generate_credentials(c)
+            app.secret_key = get_setting(c, 'secret_key')
+            conn.commit()
+        finally:
+            conn.close()
+
+def start_schedulers():
+    for site, db_file in iter_sites():
+        start_snapshot_scheduler(db_file)
+        start_overdue_scheduler(db_file, folder=reminder_folder(site))
+
+def _run_worker(sock, threaded, index):
+    global _PROCESS_ID
+    _PROCESS_ID = f"{os.getpid()}-{secrets.token_hex(2)}"
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    if index == 0:
+        start_schedulers()
+    server = make_server(*sock.getsockname()[:2], app, threaded=threaded, fd=sock.fileno())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+@app.cli.command("serve")
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=8000, type=int, show_default=True)
+@click.option("--workers", default=os.cpu_count() or 1, type=int, help="Worker processes (default: one per CPU core).")
+@click.option("--threads/--no-threads", default=True, show_default=True, help="Serve requests on threads within each worker.")
+def serve_command(host, port, workers, threads):
+    """Serve the app with several worker processes."""
+    global WORKER_PROCESSES
+    if not hasattr(os, "fork"):
+        workers = 1
+    WORKER_PROCESSES = max(workers, 1)
+    prepare_app()
+    sock = socket.create_server((host, port), backlog=128)
+    print(f"Serving on http://{host}:{port} with {WORKER_PROCESSES} worker process(es)")
+    if WORKER_PROCESSES == 1:
+        _run_worker(sock, threads, 0)
+        return
+
+    children = {}
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _run_worker(sock, threads, index)
+            finally:
+                os._exit(0)
+        children[pid] = index
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(WORKER_PROCESSES):
+        spawn(index)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            print(f"Worker {pid} exited (status {status}), restarting it.", file=sys.stderr)
+            time.sleep(1)
+            spawn(index)
+
+@app.cli.command("reset-admin")
+def reset_admin_command():
+    """Generate new admin credentials, signing out every session (restart the server afterwards)."""
+    prepare_app(new_credentials=True)
+
 if __name__ == "__main__":
-    generate_credentials()
-    init_db()
+    # With the debug reloader this block runs in both the watcher and the server process.
+    # The watcher makes (and prints) fresh credentials once; the server process just loads
+    # them, and is the only one that should be running the scheduled jobs.
+    serving = os.environ.get("WERKZEUG_RUN_MAIN") == "true"
+    prepare_app(new_credentials=not serving)
+    if serving:
+        start_schedulers()
     if "." not in sys.path:
         sys.path.append(".")
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)
@@ -0,0 +1,314 @@
+"""Route-level benchmarks against a seeded database, driven through the Flask test client.
+
+    python3 benchmark.py --save benchmark_baseline.json
+    python3 benchmark.py --compare benchmark_baseline.json
+
+Each scenario records latency percentiles, SQL statements per request and peak Python
+memory for a single request. Use the same --devices/--loans scale when comparing runs.
+
+With --url the suite instead load-tests a running server over HTTP (kiosk pages, with
+keep-alive connections), e.g. to compare `python3 app.py` against `flask serve --workers N`:
+
+    python3 benchmark.py --url http://127.0.0.1:8000 --clients 32 --duration 20
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+import seed_data
+
+_query_counter = threading.local()
+
+
+def _open_counted_connection(open_connection):
+    # Count every statement SQLite runs, per thread, so each request's total can be read back
+    def opener(db_file=None):
+        conn = open_connection(db_file)
+        conn.set_trace_callback(lambda _sql: setattr(_query_counter, 'count', getattr(_query_counter, 'count', 0) + 1))
+        return conn
+    return opener
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def logged_in_client():
+    client = app.app.test_client()
+    with client.session_transaction() as sess:
+        sess['logged_in'] = True
+    return client
+
+
+def clear_flashes(client):
+    with client.session_transaction() as sess:
+        sess.pop('_flashes', None)
+
+
+def timed(request):
+    _query_counter.count = 0
+    start = time.perf_counter()
+    response = request()
+    response.get_data()  # drain streamed bodies so the whole response is timed
+    elapsed = time.perf_counter() - start
+    if response.status_code >= 400:
+        raise RuntimeError(f"benchmark request failed with {response.status_code}")
+    return elapsed, _query_counter.count
+
+
+def summarise(latencies, queries):
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3),
+        'queries_per_request': round(sum(queries) / len(queries), 2),
+    }
+
+
+def peak_memory_kib(request):
+    tracemalloc.start()
+    try:
+        request().get_data()
+        return round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+    finally:
+        tracemalloc.stop()
+
+
+# --- Scenarios ---
+def read_scenarios(db_file):
+    conn = sqlite3.connect(db_file)
+    device_ids = [row[0] for row in conn.execute("SELECT id FROM devices")]
+    conn.close()
+    rng = random.Random(7)
+    return {
+        'loan_page': lambda client: client.get('/loan'),
+        'return_page': lambda client: client.get('/return'),
+        'admin_page': lambda client: client.get('/admin'),
+        'admin_history_api': lambda client: client.get('/admin/api/history?sort_by=loan_time_history&sort_dir=desc&limit=50'),
+        # A non-default sort, which needs its own indexes to stay flat as history grows
+        'admin_history_student': lambda client: client.get('/admin/api/history?sort_by=student_name_history&sort_dir=asc&limit=50'),
+        'device_detail': lambda client: client.get(f'/admin/device/{rng.choice(device_ids)}'),
+        'export_csv': lambda client: client.get('/export_admin_data?format=csv'),
+        'export_xlsx': lambda client: client.get('/export_admin_data'),
+    }
+
+
+def run_read_scenario(request, iterations, warmup=2):
+    client = logged_in_client()
+    for _ in range(warmup):  # fill the pool, statement cache and page cache first
+        request(client).get_data()
+    latencies, queries = [], []
+    for _ in range(iterations):
+        elapsed, count = timed(lambda: request(client))
+        latencies.append(elapsed)
+        queries.append(count)
+    result = summarise(latencies, queries)
+    result['peak_kib'] = peak_memory_kib(lambda: request(client))
+    return result
+
+
+def run_checkout_mix(db_file, clients, rounds):
+    # Each worker loans a random available device and hands it back, competing for the same stock
+    conn = sqlite3.connect(db_file)
+    available = [row[0] for row in conn.execute("SELECT id FROM devices WHERE available = 1")]
+    conn.close()
+    lock = threading.Lock()
+    samples = {'loan': ([], []), 'return': ([], [])}
+
+    def worker(n):
+        client = logged_in_client()
+        rng = random.Random(n)
+        lookup = sqlite3.connect(db_file)
+        for _ in range(rounds):
+            device_id = rng.choice(available)
+            form = {'name': 'Bench', 'surname': f'Worker{n}', 'email': f'bench.worker{n}@gdst.net',
+                    'selected_device_ids': str(device_id)}
+            loan_elapsed, loan_queries = timed(lambda: client.post('/loan', data=form))
+            row = lookup.execute("SELECT id FROM loans WHERE device_id = ? AND return_time IS NULL", (device_id,)).fetchone()
+            measured = [('loan', loan_elapsed, loan_queries)]
+            if row:
+                measured.append(('return',) + timed(lambda: client.post('/return', data={'loan_id': row[0]})))
+            clear_flashes(client)
+            with lock:
+                for kind, elapsed, count in measured:
+                    samples[kind][0].append(elapsed)
+                    samples[kind][1].append(count)
+        lookup.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(worker, range(clients)))
+    wall = time.perf_counter() - start
+
+    result = {kind: summarise(*pair) if pair[0] else None for kind, pair in samples.items()}
+    result['clients'] = clients
+    result['requests_per_second'] = round(sum(len(pair[0]) for pair in samples.values()) / wall, 1)
+    return result
+
+
+def run_scenarios(db_file, args):
+    scenarios = {}
+    for name, request in read_scenarios(db_file).items():
+        if args.only and name not in args.only:
+            continue
+        iterations = max(3, args.iterations // 10) if name.startswith('export') else args.iterations
+        scenarios[name] = run_read_scenario(request, iterations)
+        print(f"{name:<22} p50 {scenarios[name]['p50_ms']:>9.2f} ms  p95 {scenarios[name]['p95_ms']:>9.2f} ms  "
+              f"{scenarios[name]['queries_per_request']} queries  peak {scenarios[name]['peak_kib']} KiB")
+    if not args.only or 'checkout_mix' in args.only:
+        mix = run_checkout_mix(db_file, args.clients, args.rounds)
+        scenarios['checkout_mix_loan'] = mix['loan']
+        if mix['return']:
+            scenarios['checkout_mix_return'] = mix['return']
+        print(f"checkout_mix           {mix['requests_per_second']} req/s with {mix['clients']} clients  "
+              f"loan p95 {mix['loan']['p95_ms']:.2f} ms")
+    return scenarios
+
+
+# --- HTTP load test ---
+HTTP_LOAD_PATHS = ['/loan', '/return', '/loan?category=Laptop', '/return?category=Laptop']
+
+def run_http_load(base_url, clients, duration, paths=HTTP_LOAD_PATHS):
+    url = urllib.parse.urlsplit(base_url)
+    lock = threading.Lock()
+    latencies, failures = [], [0]
+    deadline = time.perf_counter() + duration
+
+    def worker(n):
+        conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+        measured, failed, i = [], 0, n
+        while time.perf_counter() < deadline:
+            path = url.path.rstrip('/') + paths[i % len(paths)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                conn.request("GET", path)
+                response = conn.getresponse()
+                response.read()
+                if response.status >= 400:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                conn.close()  # reconnects on the next request
+                failed += 1
+                continue
+            measured.append(time.perf_counter() - start)
+        conn.close()
+        with lock:
+            latencies.extend(measured)
+            failures[0] += failed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(worker, range(clients)))
+    wall = time.perf_counter() - start
+    if not latencies:
+        raise RuntimeError(f"no successful requests to {base_url}")
+    result = summarise(latencies, [0])
+    result.update({'clients': clients, 'failures': failures[0], 'requests_per_second': round(len(latencies) / wall, 1)})
+    return result
+
+
+# --- Baselines ---
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            print(f"{name:<22} (no baseline)")
+            continue
+        change = (current['p95_ms'] - previous['p95_ms']) / previous['p95_ms'] * 100 if previous['p95_ms'] else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<22} p95 {previous['p95_ms']:>9.2f} -> {current['p95_ms']:>9.2f} ms ({change:+.1f}%)  "
+              f"queries {previous['queries_per_request']} -> {current['queries_per_request']}  "
+              f"peak {previous.get('peak_kib', '-')} -> {current.get('peak_kib', '-')} KiB  "
+              f"req/s {previous.get('requests_per_second', '-')} -> {current.get('requests_per_second', '-')}{flag}")
+    if baseline.get('scale') != results['scale']:
+        print("Warning: baseline was recorded at a different data scale.")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=500)
+    parser.add_argument("--students", type=int, default=400)
+    parser.add_argument("--loans", type=int, default=20000)
+    parser.add_argument("--iterations", type=int, default=30, help="requests per read scenario")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent workers in the checkout/return mix")
+    parser.add_argument("--rounds", type=int, default=25, help="loan/return pairs per worker")
+    parser.add_argument("--only", action="append", help="run just the named scenario (repeatable)")
+    parser.add_argument("--save", metavar="PATH", help="write results to a baseline JSON file")
+    parser.add_argument("--compare", metavar="PATH", help="compare against a saved baseline")
+    parser.add_argument("--threshold", type=float, default=25.0, help="p95 slowdown, in %%, counted as a regression")
+    parser.add_argument("--url", help="load-test a running server at this base URL instead")
+    parser.add_argument("--duration", type=float, default=15.0, help="seconds of HTTP load (with --url)")
+    args = parser.parse_args(argv)
+
+    if args.url:
+        load = run_http_load(args.url, args.clients, args.duration)
+        print(f"http_load              {load['requests_per_second']} req/s with {load['clients']} clients  "
+              f"p50 {load['p50_ms']:.2f} ms  p95 {load['p95_ms']:.2f} ms  p99 {load['p99_ms']:.2f} ms  {load['failures']} failures")
+        return finish(args, {'revision': git_revision(), 'url': args.url, 'scale': None, 'scenarios': {'http_load': load}})
+
+    workdir = tempfile.mkdtemp(prefix="devicelogger-bench-")
+    db_file = os.path.join(workdir, "bench.db")
+    print(f"Seeding {args.devices} devices / {args.loans} loans into {db_file} ...")
+    seed_data.seed(db_file, args.devices, args.students, args.loans)
+    app.DB_FILE = db_file
+    app.open_db_connection = _open_counted_connection(app.open_db_connection)
+    try:
+        scenarios = run_scenarios(db_file, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'scale': {'devices': args.devices, 'students': args.students, 'loans': args.loans},
+        'scenarios': scenarios,
+    }
+    return finish(args, results)
+
+
+def finish(args, results):
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
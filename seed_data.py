@@ -0,0 +1,134 @@
+"""Fill a device-loans database with realistic synthetic data for testing and benchmarks.
+
+    python3 seed_data.py --devices 5000 --students 3000 --loans 500000 --reset
+
+Devices get category-specific rubric prefixes, every device's loans are laid out on a
+non-overlapping timeline, and only a device's most recent loan can still be open, so the
+result satisfies the same invariants as data produced by the app itself.
+"""
+import argparse
+import random
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+
+import app
+
+# Rough mix of a school's loan stock
+CATEGORY_WEIGHTS = {
+    'Laptop': 40, 'Charger': 25, 'iPad': 15, 'Headphones': 8,
+    'iPad Charger': 6, 'USBC Charger': 4, 'Trips': 1, 'Other': 1,
+}
+FIRST_NAMES = ["Amelia", "Olivia", "Isla", "Ava", "Mia", "Ivy", "Lily", "Freya", "Grace", "Sophia",
+               "Florence", "Willow", "Evie", "Poppy", "Ella", "Alice", "Harper", "Isabella", "Sienna", "Daisy"]
+SURNAMES = ["Smith", "Jones", "Taylor", "Brown", "Williams", "Wilson", "Johnson", "Davies", "Patel", "Robinson",
+            "Wright", "Thompson", "Evans", "Walker", "White", "Roberts", "Green", "Hall", "Wood", "Jackson"]
+BATCH_SIZE = 10000
+
+
+def generate_devices(count, rng):
+    categories = list(CATEGORY_WEIGHTS)
+    weights = list(CATEGORY_WEIGHTS.values())
+    next_suffix = {category: 1 for category in categories}
+    for _ in range(count):
+        category = rng.choices(categories, weights)[0]
+        suffix = next_suffix[category]
+        next_suffix[category] += 1
+        yield app.RUBRIC_PREFIXES[category], f"{suffix:03d}", category, 1, "Seeded device" if rng.random() < 0.02 else None
+
+
+def generate_students(count, rng):
+    for n in range(1, count + 1):
+        name, surname = rng.choice(FIRST_NAMES), rng.choice(SURNAMES)
+        yield name, surname, f"{name.lower()}.{surname.lower()}{n}@gdst.net"
+
+
+def generate_loans(device_ids, student_count, loan_count, start, end, active_ratio, rng):
+    # Spread loans over devices, then lay each device's loans out back to back in time
+    span = (end - start).total_seconds()
+    per_device = [0] * len(device_ids)
+    for _ in range(loan_count):
+        per_device[rng.randrange(len(device_ids))] += 1
+
+    for device_id, count in zip(device_ids, per_device):
+        if not count:
+            continue
+        starts = sorted(start + timedelta(seconds=rng.random() * span) for _ in range(count))
+        for i, loan_start in enumerate(starts):
+            is_last = i == count - 1
+            if is_last and rng.random() < active_ratio:
+                yield rng.randint(1, student_count), device_id, loan_start.isoformat(), None
+                continue
+            limit = (starts[i + 1] if not is_last else end) - loan_start
+            duration = timedelta(hours=rng.choice([1, 2, 6, 24, 72, 168]) * rng.random())
+            returned = loan_start + min(duration, limit * 0.9)
+            yield rng.randint(1, student_count), device_id, loan_start.isoformat(), returned.isoformat()
+
+
+def _batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def seed(db_file, devices=500, students=400, loans=20000, years=3, active_ratio=0.1, reset=False, random_seed=42):
+    rng = random.Random(random_seed)
+    app.init_db(db_file)
+
+    conn = sqlite3.connect(db_file)
+    try:
+        c = conn.cursor()
+        existing = c.execute("SELECT COUNT(*) FROM devices").fetchone()[0]
+        if existing and not reset:
+            raise SystemExit(f"{db_file} already has {existing} devices; pass --reset to replace its data.")
+
+        c.execute("BEGIN IMMEDIATE")
+        # Reminders and change events point at loan ids that are about to be reused
+        for table in ("reminder_log", "reminder_outbox", "change_events", "loans", "students", "devices"):
+            c.execute(f"DELETE FROM {table}")
+        c.execute("DELETE FROM sqlite_sequence WHERE name IN ('reminder_outbox', 'loans', 'students', 'devices')")
+
+        for batch in _batches(generate_devices(devices, rng)):
+            c.executemany("INSERT INTO devices (rubric_id, suffix_id, category, available, notes) VALUES (?, ?, ?, ?, ?)", batch)
+        for batch in _batches(generate_students(students, rng)):
+            c.executemany("INSERT INTO students (name, surname, email) VALUES (?, ?, ?)", batch)
+
+        device_ids = [row[0] for row in c.execute("SELECT id FROM devices ORDER BY id")]
+        end = datetime.now()
+        start = end - timedelta(days=365 * years)
+        loan_rows = sorted(generate_loans(device_ids, students, loans, start, end, active_ratio, rng), key=lambda row: row[2])
+        for batch in _batches(loan_rows):
+            c.executemany("INSERT INTO loans (student_id, device_id, loan_time, return_time) VALUES (?, ?, ?, ?)", batch)
+
+        c.execute("UPDATE devices SET available = 0 WHERE id IN (SELECT device_id FROM loans WHERE return_time IS NULL)")
+        app.backfill_due_times(c)
+        app.rebuild_stats(c)
+        conn.commit()
+        c.execute("ANALYZE")
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=app.DB_FILE, help="database file to fill (default: %(default)s)")
+    parser.add_argument("--devices", type=int, default=500)
+    parser.add_argument("--students", type=int, default=400)
+    parser.add_argument("--loans", type=int, default=20000)
+    parser.add_argument("--years", type=int, default=3, help="how far back the loan history goes")
+    parser.add_argument("--active-ratio", type=float, default=0.1, help="share of devices currently on loan")
+    parser.add_argument("--seed", type=int, default=42, help="random seed, for repeatable data")
+    parser.add_argument("--reset", action="store_true", help="delete existing devices, students and loans first")
+    args = parser.parse_args(argv)
+
+    seed(args.db, args.devices, args.students, args.loans, args.years, args.active_ratio, args.reset, args.seed)
+    print(f"Seeded {args.db}: {args.devices} devices, {args.students} students, {args.loans} loans.")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
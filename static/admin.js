@@ -6,6 +6,8 @@ document.addEventListener('DOMContentLoaded', () => {
         const modal = document.getElementById('import-modal');
         const cancelBtn = document.getElementById('cancel-import-btn');
         const confirmBtn = document.getElementById('confirm-import-btn');
+        const mergeBtn = document.getElementById('merge-import-btn');
+        const modeInput = document.getElementById('import-mode-input');
 
         // When a file is chosen, show the confirmation modal
         fileInput.addEventListener('change', function() {
@@ -23,6 +25,14 @@ document.addEventListener('DOMContentLoaded', () => {
         // If user confirms, submit the form
         confirmBtn.addEventListener('click', () => {
             modal.classList.add('hidden');
+            modeInput.value = 'replace';
+            importForm.submit();
+        });
+
+        // Merge keeps the current data and adds the file's devices, students and loans
+        mergeBtn.addEventListener('click', () => {
+            modal.classList.add('hidden');
+            modeInput.value = 'merge';
             importForm.submit();
         });
     }
@@ -33,16 +43,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const suffixInput = document.getElementById('suffix_id_input');
 
     if (categorySelect && rubricInput && suffixInput) {
-        const rubricPrefixes = {
-            'Laptop': 'SHC-LQ-',
-            'Charger': 'SHC-LP-',
-            'iPad': 'SHC-IQ-',
-            'Headphones': 'SHC-HP-',
-            'Trips': 'SHC-TRIPS-',
-            'iPad Charger': 'SHC-IPC-',
-            'USBC Charger': 'SHC-UBC-',
-            'Other': 'SHC-'
-        };
+        // Prefix rules live on the server (RUBRIC_PREFIXES) so bulk imports use the same ones
+        const rubricPrefixes = JSON.parse(categorySelect.dataset.rubricPrefixes || '{}');
 
         categorySelect.addEventListener('change', function() {
             const selectedCategory = this.value;
@@ -56,69 +58,277 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
-    // --- Logic for Delete Confirmation ---
-    const deleteForms = document.querySelectorAll('.delete-form');
-    deleteForms.forEach(form => {
-        form.addEventListener('submit', function(event) {
-            const deviceIdInput = this.querySelector('input[name="delete_id"]');
-            if (deviceIdInput) {
-                const deviceId = deviceIdInput.value;
-                if (!confirm(`Are you sure you want to delete device ID ${deviceId}?`)) {
-                    event.preventDefault(); // Stop submission if user cancels
-                }
+    // --- Logic for Bulk Device Import ---
+    // Upload as soon as a file is picked and show the per-row report without leaving the page
+    const bulkForm = document.getElementById('bulk-import-form');
+    if (bulkForm) {
+        const bulkInput = document.getElementById('bulk-import-input');
+        bulkInput.addEventListener('change', async function() {
+            if (this.files.length === 0) return;
+            const report = document.getElementById('bulk-import-report');
+            const summary = document.getElementById('bulk-import-summary');
+            const tbody = document.getElementById('bulk-import-rows');
+            report.classList.remove('hidden');
+            summary.textContent = 'Importing...';
+            tbody.innerHTML = '';
+
+            try {
+                const response = await fetch(bulkForm.action, {
+                    method: 'POST',
+                    body: new FormData(bulkForm),
+                    headers: { 'Accept': 'application/json' }
+                });
+                const result = await response.json();
+                if (!response.ok) throw new Error(result.error || `HTTP ${response.status}`);
+
+                summary.textContent = `${result.created} added, ${result.updated} updated, ${result.invalid} skipped.`;
+                result.rows.forEach(entry => {
+                    const row = tbody.insertRow();
+                    row.className = entry.status === 'invalid' ? 'bg-red-50' : '';
+                    [entry.row, entry.device_id, entry.status, entry.message].forEach(value => {
+                        row.insertCell().textContent = value;
+                    });
+                });
+            } catch (error) {
+                summary.textContent = error.message;
+            } finally {
+                bulkInput.value = '';
             }
         });
+    }
+
+    // --- Logic for Delete Confirmation ---
+    // Delegated so rows appended by "Load more" are covered too
+    document.addEventListener('submit', function(event) {
+        const form = event.target;
+        if (!form.classList || !form.classList.contains('delete-form')) return;
+        const deviceIdInput = form.querySelector('input[name="delete_id"]');
+        if (deviceIdInput) {
+            const deviceId = deviceIdInput.value;
+            if (!confirm(`Are you sure you want to delete device ID ${deviceId}?`)) {
+                event.preventDefault(); // Stop submission if user cancels
+            }
+        }
+    });
+
+    // --- Logic for Incremental Table Loading ---
+    // Each table only ships its first page; "Load more" asks the server for the next
+    // page after the cursor of the last row we already have.
+    document.querySelectorAll('.load-more').forEach(button => {
+        button.addEventListener('click', () => loadMoreRows(button));
     });
+
+    // --- Logic for Search ---
+    // Searches as you type; each result section then pages on its own with "Load More"
+    const searchBox = document.getElementById('admin-search');
+    if (searchBox) {
+        const searchInput = document.getElementById('search-input');
+        let searchTimer = null;
+        searchInput.addEventListener('input', () => {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(() => runSearch(searchInput.value), 250);
+        });
+        searchBox.querySelectorAll('.search-more').forEach(button => {
+            button.addEventListener('click', () => loadMoreResults(button));
+        });
+        // Clicking a student's email lists everything they have borrowed
+        searchBox.addEventListener('click', (event) => {
+            const link = event.target.closest('.search-link');
+            if (!link) return;
+            event.preventDefault();
+            searchInput.value = link.dataset.query;
+            runSearch(searchInput.value);
+        });
+    }
+
+    // --- Logic for Live Updates ---
+    // Loans and returns made elsewhere patch the status badges and the on-loan table in
+    // place; changes we can't place exactly (new rows in a sorted, paged table) just
+    // raise the reload notice instead of re-rendering the whole page.
+    const adminTables = document.getElementById('admin-tables');
+    const feedUrl = adminTables && adminTables.dataset.feedUrl;
+    if (feedUrl && window.EventSource) {
+        const feed = new EventSource(feedUrl);
+        const showNotice = () => document.getElementById('live-notice').classList.remove('hidden');
+        const onDevices = (handler) => (event) => JSON.parse(event.data).devices.forEach(handler);
+
+        feed.addEventListener('loan', (event) => {
+            onDevices(device => setInventoryStatus(device.id, false))(event);
+            refreshOnLoanTable();
+            showNotice();
+        });
+        feed.addEventListener('return', (event) => {
+            onDevices(device => {
+                setInventoryStatus(device.id, true);
+                document.querySelectorAll(`#on_loan-rows tr[data-device-id="${device.id}"]`).forEach(row => row.remove());
+            })(event);
+            showNotice();
+        });
+        feed.addEventListener('device_deleted', onDevices(device => {
+            document.querySelectorAll(`#inventory-rows tr[data-device-id="${device.id}"]`).forEach(row => row.remove());
+        }));
+        ['device_added', 'device_updated', 'resync', 'reload'].forEach(type => feed.addEventListener(type, showNotice));
+    }
 });
 
-// --- Logic for Frontend Sorting (No Page Refresh) ---
+// --- Logic for Server-Side Sorting ---
 // This is outside DOMContentLoaded so the HTML 'onclick' can find it.
-const sortDirections = {};
+// Tables are paged, so sorting in the browser would only reorder the rows loaded so far;
+// instead reload the page with the new sort key and let the server return the first page.
+
+/**
+ * Sorts the dashboard by the given server-side sort key.
+ * Clicking the column that is already sorted flips its direction.
+ * @param {string} sortKey
+ */
+function sortTable(sortKey) {
+    const params = new URLSearchParams(window.location.search);
+    const isCurrent = params.get('sort_by') === sortKey;
+    const nextDir = isCurrent && params.get('sort_dir') === 'asc' ? 'desc' : 'asc';
+
+    params.set('sort_by', sortKey);
+    params.set('sort_dir', nextDir);
+    window.location.search = params.toString();
+}
 
 /**
- * Sorts a table based on the column clicked.
- * @param {string} tableId 
- * @param {number} colIndex
- * @param {string} type
+ * Fetches the next page of a table and appends it.
+ * @param {HTMLButtonElement} button
  */
-function sortTable(tableId, colIndex, type = 'string') {
-    const table = document.getElementById(tableId);
-    const tbody = table.querySelector('tbody');
-    const rows = Array.from(tbody.querySelectorAll('tr'));
-    
-    // Toggle sort direction
-    const sortKey = `${tableId}-${colIndex}`;
-    sortDirections[sortKey] = !sortDirections[sortKey]; 
-    const isAscending = sortDirections[sortKey];
-
-    // Reset all icons in this table's header to the neutral state
-    table.querySelectorAll('.sort-icon').forEach(icon => icon.textContent = '↕');
-    
-    // Update the specific icon for the column being sorted
-    const headerCells = table.querySelectorAll('thead th');
-    const currentIcon = headerCells[colIndex].querySelector('.sort-icon');
-    if (currentIcon) {
-        currentIcon.textContent = isAscending ? '▲' : '▼';
+async function loadMoreRows(button) {
+    const tbody = document.getElementById(button.dataset.target);
+    const params = new URLSearchParams({
+        sort_by: button.dataset.sortBy,
+        sort_dir: button.dataset.sortDir,
+        cursor: button.dataset.nextCursor
+    });
+
+    button.disabled = true;
+    try {
+        const response = await fetch(`${button.dataset.url}?${params}`, { headers: { 'Accept': 'application/json' } });
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        const page = await response.json();
+
+        tbody.insertAdjacentHTML('beforeend', page.html);
+        button.dataset.nextCursor = page.next_cursor || '';
+        if (!page.next_cursor) button.parentElement.classList.add('hidden');
+    } catch (error) {
+        alert(`Could not load more rows: ${error.message}`);
+    } finally {
+        button.disabled = false;
     }
+}
 
-    // Perform the sort
-    const sortedRows = rows.sort((a, b) => {
-        let valA = a.cells[colIndex].textContent.trim();
-        let valB = b.cells[colIndex].textContent.trim();
 
-        if (type === 'number') {
-            // Convert to numbers for proper numeric sorting (e.g., 10 > 2)
-            const numA = parseFloat(valA.replace(/[^0-9.-]+/g, "")) || 0;
-            const numB = parseFloat(valB.replace(/[^0-9.-]+/g, "")) || 0;
-            return isAscending ? numA - numB : numB - numA;
-        }
+let searchController = null;
+
+/**
+ * Runs a search and replaces every result section with its first page.
+ * @param {string} query
+ */
+async function runSearch(query) {
+    const url = document.getElementById('admin-search').dataset.searchUrl;
+    const results = document.getElementById('search-results');
+    const status = document.getElementById('search-status');
+    if (searchController) searchController.abort(); // only the latest keystroke's results matter
+    if (!query.trim()) {
+        results.classList.add('hidden');
+        return;
+    }
 
-        // Standard alphabetical sort
-        return isAscending 
-            ? valA.localeCompare(valB, undefined, {numeric: true, sensitivity: 'base'}) 
-            : valB.localeCompare(valA, undefined, {numeric: true, sensitivity: 'base'});
+    searchController = new AbortController();
+    try {
+        const response = await fetch(`${url}?${new URLSearchParams({ q: query })}`,
+                                     { headers: { 'Accept': 'application/json' }, signal: searchController.signal });
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        const data = await response.json();
+
+        let found = 0;
+        results.querySelectorAll('[data-section]').forEach(section => {
+            const page = data[section.dataset.section];
+            section.querySelector('.search-rows').innerHTML = page.html;
+            section.classList.toggle('hidden', page.rows.length === 0);
+            setSearchCursor(section, query, page.next_cursor);
+            found += page.rows.length;
+        });
+        status.textContent = found ? '' : `No matches for "${query}".`;
+    } catch (error) {
+        if (error.name === 'AbortError') return;
+        status.textContent = `Search failed: ${error.message}`;
+    }
+    results.classList.remove('hidden');
+}
+
+/**
+ * Fetches the next page of one search section and appends it.
+ * @param {HTMLButtonElement} button
+ */
+async function loadMoreResults(button) {
+    const section = button.closest('[data-section]');
+    const url = document.getElementById('admin-search').dataset.searchUrl;
+    const params = new URLSearchParams({
+        q: button.dataset.query,
+        section: section.dataset.section,
+        cursor: button.dataset.nextCursor
     });
 
-    // Re-append the rows in the new order
-    tbody.append(...sortedRows);
+    button.disabled = true;
+    try {
+        const response = await fetch(`${url}?${params}`, { headers: { 'Accept': 'application/json' } });
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        const page = (await response.json())[section.dataset.section];
+
+        section.querySelector('.search-rows').insertAdjacentHTML('beforeend', page.html);
+        setSearchCursor(section, button.dataset.query, page.next_cursor);
+    } catch (error) {
+        alert(`Could not load more results: ${error.message}`);
+    } finally {
+        button.disabled = false;
+    }
+}
+
+/**
+ * Remembers where a search section's next page starts (and hides "Load More" at the end).
+ * @param {HTMLElement} section
+ * @param {string} query
+ * @param {?string} cursor
+ */
+function setSearchCursor(section, query, cursor) {
+    const button = section.querySelector('.search-more');
+    button.dataset.query = query;
+    button.dataset.nextCursor = cursor || '';
+    button.classList.toggle('hidden', !cursor);
+}
+
+/**
+ * Swaps a device's Loanable / Loaned Out badge in the inventory table.
+ * @param {number} deviceId
+ * @param {boolean} available
+ */
+function setInventoryStatus(deviceId, available) {
+    const cell = document.querySelector(`#inventory-rows tr[data-device-id="${deviceId}"] .device-status`);
+    if (!cell) return;
+    cell.innerHTML = available
+        ? '<span class="px-2 py-0.5 inline-flex text-xs leading-5 font-semibold rounded-full bg-green-100 text-green-800">Loanable</span>'
+        : '<span class="px-2 py-0.5 inline-flex text-xs leading-5 font-semibold rounded-full bg-red-100 text-red-800">Loaned Out</span>';
+}
+
+/**
+ * Re-fetches the first page of the on-loan table (new loans carry student details
+ * that the change feed doesn't send).
+ */
+async function refreshOnLoanTable() {
+    const button = document.querySelector('.load-more[data-table="on_loan"]');
+    if (!button) return;
+    const params = new URLSearchParams({ sort_by: button.dataset.sortBy, sort_dir: button.dataset.sortDir });
+    try {
+        const response = await fetch(`${button.dataset.url}?${params}`, { headers: { 'Accept': 'application/json' } });
+        if (!response.ok) return;
+        const page = await response.json();
+        document.getElementById(button.dataset.target).innerHTML = page.html;
+        button.dataset.nextCursor = page.next_cursor || '';
+        button.parentElement.classList.toggle('hidden', !page.next_cursor);
+    } catch (error) {
+        // The next event (or a reload) will catch the table up
+    }
 }
\ No newline at end of file
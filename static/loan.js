@@ -77,6 +77,72 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     });
 
+    // --- 3. Live Updates ---
+    // Devices loaned or returned at another kiosk are patched in without a reload.
+    const tbody = devicesTable.querySelector('tbody');
+    const deviceCountLabel = document.getElementById('device-count');
+
+    const activeCategory = () => {
+        const active = filterButtonsContainer.querySelector('.active-filter');
+        return active ? active.getAttribute('data-category') : 'All';
+    };
+
+    const refreshDeviceCount = () => {
+        if (deviceCountLabel) deviceCountLabel.textContent = tbody.querySelectorAll('.device-row').length;
+    };
+
+    const removeDeviceRow = (deviceId) => {
+        const id = String(deviceId);
+        const row = tbody.querySelector(`.device-row[data-device-id="${id}"]`);
+        if (row) row.remove();
+        if (selectedDeviceIds.includes(id)) {
+            // Someone else got it first; don't submit it with this loan
+            selectedDeviceIds = selectedDeviceIds.filter(selected => selected !== id);
+            updateSelectionUI();
+        }
+    };
+
+    const addDeviceRow = (device) => {
+        if (tbody.querySelector(`.device-row[data-device-id="${device.id}"]`)) return;
+        const row = document.createElement('tr');
+        row.className = 'device-row hover:bg-indigo-50 cursor-pointer';
+        row.setAttribute('data-device-id', device.id);
+        row.setAttribute('data-category', device.category);
+        [device.id, device.rubric_id, device.suffix_id, device.category].forEach((value, index) => {
+            const cell = document.createElement('td');
+            if (index === 0) cell.className = 'font-bold';
+            cell.textContent = value;
+            row.appendChild(cell);
+        });
+        const category = activeCategory();
+        if (category !== 'All' && category !== device.category) row.style.display = 'none';
+
+        // Keep the table in id order, as rendered by the server
+        const next = Array.from(tbody.querySelectorAll('.device-row'))
+            .find(existing => Number(existing.getAttribute('data-device-id')) > device.id);
+        tbody.insertBefore(row, next || null);
+    };
+
+    const formIsUntouched = () => selectedDeviceIds.length === 0 &&
+        ['name', 'surname', 'email'].every(id => !document.getElementById(id).value);
+
+    const feedUrl = devicesTable.getAttribute('data-feed-url');
+    if (feedUrl && window.EventSource) {
+        const feed = new EventSource(feedUrl);
+        const onDevices = (handler) => (event) => {
+            JSON.parse(event.data).devices.forEach(handler);
+            refreshDeviceCount();
+        };
+        feed.addEventListener('loan', onDevices(device => removeDeviceRow(device.id)));
+        feed.addEventListener('device_deleted', onDevices(device => removeDeviceRow(device.id)));
+        feed.addEventListener('return', onDevices(addDeviceRow));
+        feed.addEventListener('device_added', onDevices(addDeviceRow));
+        // Missed events or a replaced database: only safe to reload if nothing has been entered yet
+        const reloadIfIdle = () => { if (formIsUntouched()) window.location.reload(); };
+        feed.addEventListener('resync', reloadIfIdle);
+        feed.addEventListener('reload', reloadIfIdle);
+    }
+
     // Initialize "Show All"
     const allButton = document.querySelector('[data-category="All"]');
     if(allButton) allButton.classList.add('active-filter');
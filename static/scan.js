@@ -0,0 +1,71 @@
+document.addEventListener('DOMContentLoaded', () => {
+    const form = document.getElementById('scan-form');
+    const scanInput = document.getElementById('scan-input');
+    const studentFields = document.getElementById('student-fields');
+    const scanLog = document.getElementById('scan-log');
+    const scanCount = document.getElementById('scan-count');
+    const okCount = document.getElementById('scan-ok-count');
+    const scanUrl = form.getAttribute('data-scan-url');
+
+    let total = 0;
+    let succeeded = 0;
+
+    const currentAction = () => form.querySelector('input[name="action"]:checked').value;
+
+    // --- 1. Mode Switching ---
+    form.querySelectorAll('input[name="action"]').forEach(radio => {
+        radio.addEventListener('change', () => {
+            studentFields.classList.toggle('hidden', currentAction() !== 'checkout');
+            scanInput.focus();
+        });
+    });
+
+    // --- 2. Scanning ---
+    // Scanners "type" the barcode and press Enter. Each scan is sent straight away without
+    // waiting for the previous one, so the server can group-commit a burst of scans together.
+    const sendScan = async (deviceId) => {
+        const row = scanLog.insertRow(0);
+        const [idCell, statusCell, messageCell] = [row.insertCell(), row.insertCell(), row.insertCell()];
+        [idCell, statusCell, messageCell].forEach(cell => cell.className = 'p-3');
+        idCell.textContent = deviceId;
+        statusCell.textContent = 'pending';
+        total += 1;
+        scanCount.textContent = total;
+
+        const payload = { device_id: deviceId, action: currentAction() };
+        if (payload.action === 'checkout') {
+            ['name', 'surname', 'email'].forEach(field => payload[field] = document.getElementById(field).value);
+        }
+
+        try {
+            const response = await fetch(scanUrl, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json', 'Accept': 'application/json' },
+                body: JSON.stringify(payload)
+            });
+            const ack = await response.json();
+            statusCell.textContent = ack.status;
+            messageCell.textContent = ack.message;
+            const ok = ack.status === 'returned' || ack.status === 'loaned';
+            row.className = ok ? 'bg-green-50' : 'bg-red-50';
+            if (ok) {
+                succeeded += 1;
+                okCount.textContent = succeeded;
+            }
+        } catch (error) {
+            statusCell.textContent = 'error';
+            messageCell.textContent = error.message;
+            row.className = 'bg-red-50';
+        }
+    };
+
+    scanInput.addEventListener('keydown', (event) => {
+        if (event.key !== 'Enter') return;
+        event.preventDefault();
+        const deviceId = scanInput.value.trim();
+        scanInput.value = '';
+        if (deviceId) sendScan(deviceId);
+    });
+
+    form.addEventListener('submit', (event) => event.preventDefault());
+});
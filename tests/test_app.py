@@ -0,0 +1,148 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as app_module
+
+
+@pytest.fixture
+def db_file(tmp_path, monkeypatch):
+    # Everything the app keeps per database is keyed by file name, so a fresh file is a fresh app
+    monkeypatch.chdir(tmp_path)
+    db_file = str(tmp_path / "test.db")
+    monkeypatch.setattr(app_module, "DB_FILE", db_file)
+    app_module.init_db(db_file)
+    return db_file
+
+
+@pytest.fixture
+def client(db_file):
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+    return client
+
+
+def add_devices(db_file, count):
+    with app_module.pooled_connection(db_file) as conn:
+        conn.executemany("INSERT INTO devices (rubric_id, suffix_id, category, available) VALUES ('SHC-LQ-', ?, 'Laptop', 1)",
+                         [(f"{i:03d}",) for i in range(count)])
+        conn.commit()
+        return [row[0] for row in conn.execute("SELECT id FROM devices ORDER BY id")]
+
+
+def test_event_stream_rejects_subscribers_over_the_cap(client, db_file):
+    feed = app_module.get_change_feed(db_file)
+    feed.max_subscribers = 2
+    streams = [client.get('/events', buffered=False) for _ in range(2)]
+    try:
+        assert [s.status_code for s in streams] == [200, 200]
+        for s in streams:
+            next(s.response)  # start the generator, so closing it runs its cleanup
+        rejected = client.get('/events')
+        assert rejected.status_code == 503
+        assert rejected.headers['Retry-After'] == str(app_module.FEED_HEARTBEAT_SECONDS)
+        assert feed.subscriber_count() == 2
+    finally:
+        for s in streams:
+            s.close()
+    assert feed.subscriber_count() == 0
+    assert client.get('/events', buffered=False).status_code == 200
+
+
+def test_subscriber_that_falls_behind_gets_a_single_resync():
+    feed = app_module.ChangeFeed(queue_size=2)
+    q = feed.subscribe()
+    for _ in range(5):
+        feed.publish('loan', {'devices': []})
+    events = list(q.queue)
+    assert [e['type'] for e in events] == ['resync']
+    assert events[0]['id'] == feed.last_id
+
+
+def test_concurrent_checkouts_never_loan_a_device_twice(db_file):
+    device_ids = add_devices(db_file, 5)
+    kiosks = 8
+    start = threading.Barrier(kiosks)
+    results = []
+
+    def checkout(n):
+        conn = app_module.open_db_connection(db_file)
+        try:
+            start.wait()
+            loaned, lost = app_module.checkout_devices(conn, "Student", str(n), f"student{n}@gdst.net", device_ids)
+            results.append([row[0] for row in loaned])
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=checkout, args=(n,)) for n in range(kiosks)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    claimed = [device_id for loaned in results for device_id in loaned]
+    assert sorted(claimed) == device_ids
+    with app_module.pooled_connection(db_file) as conn:
+        open_loans = conn.execute("SELECT device_id, COUNT(*) FROM loans WHERE return_time IS NULL GROUP BY device_id").fetchall()
+        assert sorted(open_loans) == [(device_id, 1) for device_id in device_ids]
+        assert conn.execute("SELECT COUNT(*) FROM devices WHERE available = 1").fetchone()[0] == 0
+
+
+def test_merge_leaves_at_most_one_open_loan_per_device(db_file, tmp_path):
+    device_ids = add_devices(db_file, 2)
+    with app_module.pooled_connection(db_file) as conn:
+        app_module.checkout_devices(conn, "Local", "Student", "local@gdst.net", [device_ids[0]], "2024-03-01T09:00:00")
+        app_module.checkout_devices(conn, "Local", "Student", "local@gdst.net", [device_ids[1]], "2024-03-05T09:00:00")
+
+    # The other site has the same devices out: SHC-LQ--000 more recently, SHC-LQ--001 earlier
+    staged = str(tmp_path / "other.db")
+    app_module.init_db(staged)
+    other = app_module.sqlite3.connect(staged)
+    other.executemany("INSERT INTO devices (rubric_id, suffix_id, category, available) VALUES ('SHC-LQ-', ?, 'Laptop', 0)", [("000",), ("001",)])
+    other.execute("INSERT INTO students (name, surname, email) VALUES ('Other', 'Student', 'other@gdst.net')")
+    other.executemany("INSERT INTO loans (student_id, device_id, loan_time) VALUES (1, ?, ?)",
+                      [(1, "2024-03-02T10:00:00"), (2, "2024-03-04T10:00:00")])
+    other.commit()
+    other.close()
+
+    app_module.merge_from_staged(staged, db_file)
+
+    with app_module.pooled_connection(db_file) as conn:
+        loans = conn.execute("""SELECT d.suffix_id, s.email, l.loan_time, l.return_time FROM loans l
+                                JOIN devices d ON d.id = l.device_id JOIN students s ON s.id = l.student_id
+                                ORDER BY d.suffix_id, l.loan_time""").fetchall()
+        assert loans == [
+            ("000", "local@gdst.net", "2024-03-01T09:00:00", "2024-03-02T10:00:00"),
+            ("000", "other@gdst.net", "2024-03-02T10:00:00", None),
+            ("001", "other@gdst.net", "2024-03-04T10:00:00", "2024-03-05T09:00:00"),
+            ("001", "local@gdst.net", "2024-03-05T09:00:00", None),
+        ]
+        assert conn.execute("SELECT COUNT(*) FROM devices WHERE available = 0").fetchone()[0] == 2
+        assert conn.execute("SELECT SUM(returns) FROM stats_device").fetchone()[0] == 2
+
+
+def test_return_page_only_caches_categories_that_have_loans(client, db_file):
+    device_ids = add_devices(db_file, 1)
+    with app_module.pooled_connection(db_file) as conn:
+        app_module.checkout_devices(conn, "Some", "Student", "some@gdst.net", device_ids, "2024-03-01T09:00:00")
+    cache_keys = lambda: {key for db, key in app_module._page_cache if db == db_file}
+
+    for i in range(20):
+        assert client.get(f'/return?category=junk{i}').status_code == 200
+    assert client.get('/return?category=Laptop').status_code == 200
+    assert cache_keys() == {'loaned_categories', ('active_loans', 'Laptop')}
+
+
+@pytest.mark.parametrize("body", [[1, 2], "SHC-LQ--000", 42,
+                                  {'device_id': 'SHC-LQ--000', 'action': 'checkout', 'email': ['x@gdst.net'], 'name': 'A', 'surname': 'B'},
+                                  {'device_id': 'SHC-LQ--000', 'action': 'checkout', 'email': 'x@gdst.net', 'name': 1, 'surname': None},
+                                  {'device_id': ['SHC-LQ--000'], 'action': ['return']}])
+def test_scan_station_rejects_malformed_scans(client, db_file, body):
+    add_devices(db_file, 1)
+    response = client.post('/scan', json=body)
+    assert response.status_code == 400
+    assert response.get_json()['status'] == 'error'